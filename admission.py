@@ -0,0 +1,108 @@
+import asyncio
+from contextlib import asynccontextmanager
+import math
+import time
+
+import config
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Run queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# Limits how many runs use the browser pool at once, globally and per
+# target host, and how many may wait for a slot. Callers reserve() their
+# runs when a job is submitted, which fails fast with AdmissionRejected
+# once the wait queue is full, then hold slot(host) for each run.
+class AdmissionController:
+    def __init__(
+        self,
+        max_runs=config.MAX_RUNS,
+        max_runs_per_host=config.MAX_RUNS_PER_HOST,
+        max_waiting=config.MAX_WAITING_RUNS,
+    ):
+        self.max_runs = max_runs
+        self.max_runs_per_host = max_runs_per_host
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+        self.admitted = 0
+        self.wait_seconds_total = 0
+        self.wait_seconds_max = 0
+        # Moving average used to estimate Retry-After
+        self.run_seconds_avg = 10
+        self._slots = asyncio.Semaphore(max_runs)
+        # host -> [semaphore, runs holding or waiting for it]
+        self._host_slots = {}
+
+    def reserve(self, count):
+        if self.waiting + count > self.max_waiting:
+            self.rejected += count
+            raise AdmissionRejected(self.retry_after())
+        self.waiting += count
+
+    # Give back reservations for runs that will never ask for a slot
+    def cancel(self, count):
+        self.waiting -= count
+
+    def retry_after(self):
+        batches = math.ceil((self.waiting + self.running) / self.max_runs)
+        return max(1, math.ceil(batches * self.run_seconds_avg))
+
+    # Waits for a slot on the host first, so a run for a busy host never
+    # holds one of the global slots while it waits
+    @asynccontextmanager
+    async def slot(self, host):
+        queued_at = time.monotonic()
+        host_slot = self._host_slots.setdefault(
+            host, [asyncio.Semaphore(self.max_runs_per_host), 0]
+        )
+        host_slot[1] += 1
+        waiting = True
+        try:
+            async with host_slot[0], self._slots:
+                waited = time.monotonic() - queued_at
+                self.waiting -= 1
+                waiting = False
+                self.admitted += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+                self.running += 1
+                started_at = time.monotonic()
+                try:
+                    yield
+                finally:
+                    self.running -= 1
+                    run_seconds = time.monotonic() - started_at
+                    self.run_seconds_avg += (run_seconds - self.run_seconds_avg) / 10
+        finally:
+            if waiting:
+                self.waiting -= 1
+            host_slot[1] -= 1
+            if host_slot[1] == 0:
+                del self._host_slots[host]
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "max_runs": self.max_runs,
+            "max_runs_per_host": self.max_runs_per_host,
+            "max_waiting": self.max_waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds_avg": self.wait_seconds_total / max(1, self.admitted),
+            "wait_seconds_max": self.wait_seconds_max,
+            "busy_hosts": len(self._host_slots),
+        }
+
+
+admission = AdmissionController()
+metrics_admission = AdmissionController(
+    max_runs=config.MAX_METRICS_RUNS,
+    max_runs_per_host=config.MAX_METRICS_RUNS_PER_HOST,
+    max_waiting=config.MAX_WAITING_METRICS_RUNS,
+)
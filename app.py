@@ -1,93 +1,420 @@
-import asyncio
-from quart import Quart, render_template, websocket, redirect, url_for, request
+import re
+from quart import Quart, render_template, websocket, redirect, url_for, request, abort
+from werkzeug.utils import safe_join
 
 import uuid
+from urllib.parse import urlsplit
+from pathlib import Path
 from create_results_page import create_standalone_html_file
 
 # from web_run import process_with_selenium
-from web_pw_run import load_page_with_screenshots
+from web_pw_run import network_conditions
+from browser_pool import browser_pool
+from video_encoder import ENCODING_PROFILES, encode_stage, video_filename
+from jobs import Job, JobManager, expand_matrix, run_spec
+from admission import AdmissionRejected, admission, metrics_admission
+from result_cache import result_cache
+from retention import ResultsCollector
+from network_shaping import shaping_proxy
+from runs import SLOW_NETWORK_PROFILE, run_option
+from job_store import open_job_store
+from telemetry import CONTENT_TYPE, REGISTRY, Gauge, timed
+from artifacts import send_artifact
+import config
 
 from logger import logger
 
 app = Quart(__name__)
 app.config["SESSION_REVERSE_PROXY"] = True
 
+TEST_OPTIONS = [
+    "disableJavascript",
+    "disableCSS",
+    "disableImages",
+    "slowNetwork",
+    "offlineMode",
+    "highLatency",
+]
+RESOLUTION_PATTERN = re.compile(r"[1-9][0-9]{2,3}x[1-9][0-9]{2,3}")
+# Fields submitted as lists of strings, the others are single strings
+LIST_FIELDS = {"options", "network_profiles", "resolutions"}
+# Error for a submitted field (or list item) that is not a string
+FIELD_ERRORS = {
+    "url": "An http or https URL is required",
+    "options": "Select at least one option",
+    "resolution": "Invalid resolution",
+    "network_profiles": "Select at least one network profile and resolution",
+    "resolutions": "Select at least one network profile and resolution",
+    "encoding_profile": "Unknown encoding profile",
+}
+
+
+# Launch the shared browsers once so runs only pay for a new context
+# (with a job store the workers run the browsers instead)
+@app.before_serving
+async def start_browser_pool():
+    if job_store is None:
+        await browser_pool.start()
+        encode_stage.start()
+    results_collector.start()
+
+
+@app.after_serving
+async def stop_browser_pool():
+    await results_collector.stop()
+    await job_manager.stop()
+    if job_store is None:
+        await encode_stage.stop()
+        await browser_pool.stop()
+        await shaping_proxy.stop()
+    else:
+        await job_store.close()
+
 
 @app.route("/", methods=["GET", "POST"])
 async def index():
     if request.method == "POST":
         form_data = await request.form
-        url = form_data["url"]
-        options = form_data.getlist("options")
-        resolution = form_data.get("resolution", "1024x768")
-        session_id = str(uuid.uuid4())
-
-        # Load the page with selected option and create screenshots
-        tasks = []
-        for option in options:
-            # Create distinct flags for each option/task
-            disable_js = "disableJavascript" == option
-            disable_images = "disableImages" == option
-            disable_css = "disableCSS" == option
-            slow_route = "highLatency" == option
-            slow_network_chrome = "slowNetwork" == option
-
-            logger.info(
-                f"Creating task for option: {option} - Flags: disable_js: {disable_js}, disable_images: {disable_images}, disable_css: {disable_css}, slow_route: {slow_route}, slow_network_chrome: {slow_network_chrome}"
+        job, error = submit_job(form_data)
+        if error:
+            return error, 400
+        return redirect(url_for("job_page", job_id=job.job_id))
+    return await render_template(
+        "index.html",
+        network_profiles=network_conditions,
+        encoding_profiles=ENCODING_PROFILES,
+        default_encoding_profile=config.ENCODING_PROFILE,
+    )
+
+
+# Same as the index form but answers with the job id right away, 202 Accepted
+@app.route("/api/jobs", methods=["POST"])
+async def create_job():
+    data = await request.get_json(silent=True)
+    if data is None:
+        data = await request.form
+    job, error = submit_job(data)
+    if error:
+        return {"error": error}, 400
+    return (
+        {
+            "job_id": job.job_id,
+            "status_url": url_for("job_status", job_id=job.job_id),
+            "websocket_url": url_for("job_updates", job_id=job.job_id),
+            "page_url": url_for("job_page", job_id=job.job_id),
+        },
+        202,
+    )
+
+
+# Raised by submit_job once the run queue is full
+@app.errorhandler(AdmissionRejected)
+async def queue_full(error):
+    return {"error": str(error)}, 429, {"Retry-After": str(error.retry_after)}
+
+
+# Queue depth, wait times and pipeline counters
+@app.route("/api/status")
+async def status():
+    stats = {
+        "admission": admission.stats(),
+        "metrics_admission": metrics_admission.stats(),
+        "browser_pool": browser_pool.stats(),
+        "encoding": encode_stage.stats(),
+        "network_shaping": shaping_proxy.stats(),
+        "result_cache": result_cache.stats(),
+        "retention": results_collector.stats(),
+    }
+    if job_store is not None:
+        stats["job_store"] = await job_store.stats()
+    return stats
+
+
+# Prometheus scrape endpoint: stage histograms, pipeline counters and
+# gauges read from the same stats as /api/status
+@app.route("/metrics")
+async def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+# Session artifacts, in place of the default static handler for results.
+# Final files are cached as immutable, the others revalidated by ETag;
+# ranges make video seeking fetch only what is played.
+@app.route("/static/results/<session_id>/<path:filename>")
+async def artifact(session_id, filename):
+    path = safe_join("static/results", session_id, filename)
+    response = None
+    if path is not None:
+        response = await send_artifact(Path(path), artifact_final(session_id, filename))
+    if response is None:
+        abort(404)
+    return response
+
+
+@app.route("/api/jobs/<job_id>")
+async def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return job.snapshot()
+
+
+# Results page that fills in as each option finishes
+@app.route("/jobs/<job_id>")
+async def job_page(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return "Unknown job", 404
+    snapshot = job.snapshot()
+    runs = {run["run_id"]: run for run in snapshot["runs"]}
+    return await render_template("job.html", job=snapshot, runs=runs)
+
+
+# Pushes the job snapshot, then one event per run update until the job ends
+@app.websocket("/ws/jobs/<job_id>")
+async def job_updates(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        await websocket.close(1008)
+        return
+    queue = job.subscribe()
+    try:
+        await websocket.send_json(job.snapshot())
+        finished = job.finished
+        while not finished:
+            event = await queue.get()
+            await websocket.send_json(event)
+            finished = event["type"] == "job"
+    finally:
+        job.unsubscribe(queue)
+
+
+# Accepts form or JSON data (list fields may be lists in both). Giving
+# network_profiles or resolutions runs the option x profile x resolution
+# matrix instead of one run per option. metrics_only skips the video,
+# har_replay replays every run from a single recording of the page and
+# encoding_profile picks how videos are encoded. Returns (job, error)
+def submit_job(data):
+    if not isinstance(data, dict):
+        return None, "Expected form fields or a JSON object"
+    for key, error in FIELD_ERRORS.items():
+        if key in LIST_FIELDS:
+            valid = all(isinstance(value, str) for value in get_list(data, key))
+        else:
+            valid = isinstance(data.get(key), (str, type(None)))
+        if not valid:
+            return None, error
+    url = data.get("url")
+    options = get_list(data, "options")
+    resolution = data.get("resolution") or "1024x768"
+    network_profiles = get_list(data, "network_profiles")
+    resolutions = get_list(data, "resolutions")
+    encoding_profile = data.get("encoding_profile") or config.ENCODING_PROFILE
+    # Options and resolutions name result files, so only known ones are accepted
+    options = [option for option in dict.fromkeys(options) if option in TEST_OPTIONS]
+    # Only web pages: the URL goes to the browser and is linked on job pages
+    try:
+        parts = urlsplit(url or "")
+    except ValueError:
+        parts = None
+    if not parts or parts.scheme not in ("http", "https") or not parts.hostname:
+        return None, "An http or https URL is required"
+    if not options:
+        return None, "Select at least one option"
+    if encoding_profile not in ENCODING_PROFILES:
+        return None, "Unknown encoding profile"
+
+    if network_profiles or resolutions:
+        network_profiles = [
+            None if profile == "none" else profile
+            for profile in dict.fromkeys(network_profiles or ["none"])
+            if profile == "none" or profile in network_conditions
+        ]
+        resolutions = [
+            resolution
+            for resolution in dict.fromkeys(resolutions or [resolution])
+            if RESOLUTION_PATTERN.fullmatch(resolution)
+        ]
+        if not network_profiles or not resolutions:
+            return None, "Select at least one network profile and resolution"
+        runs, matrix = expand_matrix(options, network_profiles, resolutions)
+    else:
+        if not RESOLUTION_PATTERN.fullmatch(resolution):
+            return None, "Invalid resolution"
+        runs = [
+            run_spec(
+                option,
+                SLOW_NETWORK_PROFILE if option == "slowNetwork" else None,
+                resolution,
+                run_id=option,
             )
+            for option in options
+        ]
+        matrix = None
+
+    session_id = str(uuid.uuid4())
+    metrics_only = get_flag(data, "metrics_only")
+    job = Job(
+        session_id,
+        url,
+        runs,
+        format_results(session_id, runs, matrix, metrics_only, encoding_profile),
+        url_for("static", filename=f"results/{session_id}/results_page.html"),
+        force_refresh=get_flag(data, "force_refresh"),
+        matrix=matrix,
+        metrics_only=metrics_only,
+        replay=get_flag(data, "har_replay"),
+        encoding_profile=encoding_profile,
+    )
+    # A job larger than the wait queue would be rejected on every retry
+    max_runs = job_manager.admission_for(job).max_waiting
+    if len(runs) > max_runs:
+        return None, f"A job can have at most {max_runs} runs, this one has {len(runs)}"
+    return job_manager.submit(job), None
+
 
-            task = asyncio.create_task(
-                load_page_with_screenshots(
-                    session_id=session_id,
-                    test_type=option,
-                    url=url,
-                    screenshot_interval=0.05,
-                    load_duration=10,
-                    disable_js=disable_js,
-                    disable_images=disable_images,
-                    disable_css=disable_css,
-                    slow_route=slow_route,
-                    slow_network_chrome=slow_network_chrome,
-                    screen_resolution=resolution,
-                )
+def get_list(data, key):
+    if hasattr(data, "getlist"):
+        return data.getlist(key)
+    value = data.get(key)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+# Checkbox values from the form, booleans or strings from JSON
+def get_flag(data, key):
+    return str(data.get(key, "")).lower() in ("on", "true", "1")
+
+
+# Write the standalone results page once every run has ended
+async def finish_job(job):
+    formatted_results = [
+        job.results[run_id] for run_id in job.run_ids if job.runs[run_id] == "done"
+    ]
+    async with app.app_context():
+        with timed("results_page"):
+            output_path = await create_standalone_html_file(
+                job.job_id, formatted_results, matrix=job.matrix
             )
-            tasks.append(task)
+    logger.info(f"Created standalone HTML file at {output_path}")
+    return job.results_page_url
+
 
-        await asyncio.gather(*tasks)
+# Runs go to worker processes (worker.py) when EDGECASER_JOB_STORE is set
+job_store = open_job_store() if config.JOB_STORE else None
+job_manager = JobManager(
+    run_option, finish_job, admission, metrics_admission, store=job_store
+)
 
-        # Process return data from the select test options to render on page
-        formatted_results = format_results(session_id, options)
-        output_path = await create_standalone_html_file(session_id, formatted_results)
-        logger.info(f"Created standalone HTML file at {output_path}")
 
-        return redirect(
-            url_for("static", filename=f"results/{session_id}/results_page.html")
-        )
-    return await render_template("index.html")
+def session_active(session_id):
+    job = job_manager.get(session_id)
+    return job is not None and not job.finished
+
+
+results_collector = ResultsCollector(is_active=session_active)
+
+
+# Files of a done run, and the results page, of a job this process saw
+# finish never change again. Anything else (jobs still running or unknown
+# to this process, e.g. after a restart, and the result cache index) may.
+def artifact_final(session_id, filename):
+    job = job_manager.get(session_id)
+    if job is None or not job.finished:
+        return False
+    if filename in ("results_page.html", "results_page.html.gz"):
+        return True
+    return any(
+        status == "done" and filename.startswith(f"{run_id}.")
+        for run_id, status in job.runs.items()
+    )
+
+
+Gauge(
+    "edgecaser_runs_in_progress",
+    "Runs holding a browser slot",
+    lambda: {"video": admission.running, "metrics_only": metrics_admission.running},
+    labels=("queue",),
+)
+Gauge(
+    "edgecaser_runs_waiting",
+    "Runs waiting for a browser slot",
+    lambda: {"video": admission.waiting, "metrics_only": metrics_admission.waiting},
+    labels=("queue",),
+)
+Gauge(
+    "edgecaser_browser_contexts",
+    "Open browser contexts",
+    lambda: browser_pool.stats()["active_contexts"],
+)
+Gauge("edgecaser_encodes_active", "Running ffmpeg encodes", lambda: encode_stage.active)
+Gauge(
+    "edgecaser_encodes_queued",
+    "Deferred encodes waiting for a slot",
+    lambda: encode_stage.stats()["queued"],
+)
+Gauge(
+    "edgecaser_frame_buffer_bytes",
+    "Frame bytes held in memory by deferred encodes",
+    encode_stage.buffered_bytes,
+)
 
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", debug=True)
 
 
-def format_results(session_id, options):
+def format_results(
+    session_id,
+    runs,
+    matrix=None,
+    metrics_only=False,
+    encoding_profile=config.ENCODING_PROFILE,
+):
     formatted_results = []
 
-    # Each option results in a single test execution
-    for option in options:
-        # Filenames are derived from the option directly
-        video_filename = f"{option}.mp4"
-        log_filename = f"{option}.log"  # Placeholder
+    # Each run results in a single test execution
+    for spec in runs:
+        # Filenames are derived from the run id directly
+        video_file = video_filename(spec["run_id"], encoding_profile)
+        poster_filename = f"{spec['run_id']}.poster.jpg"
+        filmstrip_filename = f"{spec['run_id']}.filmstrip.jpg"
+        metrics_filename = f"{spec['run_id']}.json"
+        log_filename = f"{spec['run_id']}.log.ndjson.gz"
+
+        options_str = spec["option"].replace("_", " ").title()
+        if matrix:
+            profile = spec["network_profile"] or "No throttling"
+            options_str = f"{options_str} - {profile} - {spec['resolution']}"
+
+        video_url = poster_url = filmstrip_url = None
+        if not metrics_only:
+            video_url = url_for("static", filename=f"results/{session_id}/{video_file}")
+            # Shown first; the video is only fetched once it is played
+            poster_url = url_for(
+                "static", filename=f"results/{session_id}/{poster_filename}"
+            )
+            filmstrip_url = url_for(
+                "static", filename=f"results/{session_id}/{filmstrip_filename}"
+            )
 
         result = {
-            # TOOD: implement saving logs from Playwright
+            "run_id": spec["run_id"],
+            # Browser console, page errors and network log (see run_log.py)
             "log_url": url_for(
-                "static", filename=f"results/{session_id}/logs/{log_filename}"
+                "static", filename=f"results/{session_id}/{log_filename}"
             ),
-            "options_str": option.replace("_", " ").title(),
-            "video_url": url_for(
-                "static", filename=f"results/{session_id}/{video_filename}"
+            "options_str": options_str,
+            "video_url": video_url,
+            "poster_url": poster_url,
+            "filmstrip_url": filmstrip_url,
+            "filmstrip_interval_ms": config.FILMSTRIP_INTERVAL_MS,
+            "metrics_url": url_for(
+                "static", filename=f"results/{session_id}/{metrics_filename}"
             ),
+            # Filled in from the metrics file once the run is done
+            "metrics": None,
         }
         formatted_results.append(result)
 
@@ -0,0 +1,185 @@
+"""Synthetic pages for the benchmarks, served from memory on localhost.
+
+    /images.html  many raster images that fill in as they load
+    /css.html     many large stylesheets
+    /js.html      a script that keeps the main thread busy and the DOM changing
+    /slow.html    an HTML document streamed in chunks over a few seconds
+
+Nothing is fetched from outside the server, so benchmarks run offline.
+
+    python benchmarks/fixture_site.py --port 8000
+"""
+
+import argparse
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import threading
+import time
+
+from PIL import Image
+
+PAGES = {
+    "images": "/images.html",
+    "css": "/css.html",
+    "js": "/js.html",
+    "slow": "/slow.html",
+}
+IMAGES = 60
+STYLESHEETS = 20
+RULES_PER_STYLESHEET = 500
+SLOW_CHUNKS = 20
+SLOW_CHUNK_DELAY = 0.15
+
+
+def page(title, head, body):
+    return (
+        f"<!doctype html><html><head><title>{title}</title>{head}</head>"
+        f"<body>{body}</body></html>"
+    ).encode()
+
+
+@lru_cache(maxsize=None)
+def image(index):
+    # A gradient per image so every one changes the rendered frame
+    gradient = Image.linear_gradient("L").resize((240, 160))
+    tint = Image.new("RGB", gradient.size, ((index * 37) % 256, 90, 200))
+    picture = Image.composite(tint, Image.new("RGB", gradient.size), gradient)
+    buffer = io.BytesIO()
+    picture.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=None)
+def stylesheet(index):
+    rules = "".join(
+        f".s{index}-{rule} {{ color: #{(rule * 2654435761) % 0xFFFFFF:06x}; "
+        f"padding: {rule % 7}px; border-left: {rule % 5}px solid #888; }}\n"
+        for rule in range(RULES_PER_STYLESHEET)
+    )
+    return rules.encode()
+
+
+def images_page():
+    tags = "".join(
+        f'<img src="/img/{index}.png" width="240" height="160">'
+        for index in range(IMAGES)
+    )
+    return page("Images", "", tags)
+
+
+def css_page():
+    links = "".join(
+        f'<link rel="stylesheet" href="/css/{index}.css">'
+        for index in range(STYLESHEETS)
+    )
+    cells = "".join(
+        f'<div class="s{index % STYLESHEETS}-{index}">Styled block {index}</div>'
+        for index in range(300)
+    )
+    return page("Stylesheets", links, cells)
+
+
+def js_page():
+    # 50 ms long tasks, each adding a row, for about three seconds
+    script = """
+<script>
+let row = 0;
+function work() {
+    const until = performance.now() + 50;
+    let value = 0;
+    while (performance.now() < until) value += Math.sqrt(Math.random());
+    const div = document.createElement("div");
+    div.textContent = `Row ${row} ${value.toFixed(2)}`;
+    div.style.background = `hsl(${row * 7 % 360}, 60%, 70%)`;
+    document.body.appendChild(div);
+    if (++row < 40) setTimeout(work, 25);
+}
+work();
+</script>
+"""
+    return page("Script", "", script)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    routes = {
+        "/images.html": ("text/html", images_page),
+        "/css.html": ("text/html", css_page),
+        "/js.html": ("text/html", js_page),
+    }
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/slow.html":
+            self.send_slow_page()
+        elif path in self.routes:
+            content_type, render = self.routes[path]
+            self.send_body(content_type, render())
+        elif path.startswith("/img/") and path.endswith(".png"):
+            self.send_body("image/png", image(int(path[5:-4])))
+        elif path.startswith("/css/") and path.endswith(".css"):
+            self.send_body("text/css", stylesheet(int(path[5:-4])))
+        else:
+            self.send_body("text/plain", b"Not found", status=404)
+
+    def send_body(self, content_type, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    # No Content-Length: the document ends when the connection closes
+    def send_slow_page(self):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(b"<!doctype html><html><head><title>Slow</title></head><body>")
+        for chunk in range(SLOW_CHUNKS):
+            self.wfile.write(
+                f'<div style="height: 30px; background: hsl({chunk * 18}, 60%, 70%)">'
+                f"Chunk {chunk}</div>".encode()
+                + b" " * 2048  # Enough bytes for the parser to render each chunk
+            )
+            self.wfile.flush()
+            time.sleep(SLOW_CHUNK_DELAY)
+        self.wfile.write(b"</body></html>")
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Starts the fixture site on a background thread. Stop it with
+# server.shutdown().
+def serve(host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def page_urls(server):
+    host, port = server.server_address[:2]
+    return {name: f"http://{host}:{port}{path}" for name, path in PAGES.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server = serve(port=args.port)
+    for name, url in page_urls(server).items():
+        print(f"{name}: {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""End-to-end throughput of the capture pipeline against the fixture site.
+
+Serves the synthetic pages of fixture_site.py on localhost and measures:
+
+- direct: load_page_with_screenshots on every page, one run at a time:
+  runs/sec, frames captured per second, capture interval jitter, encode
+  time, peak RSS of the process tree and disk bytes per session
+- post: the full flow through the Quart app (POST /api/jobs, then
+  polling the job until it ends) with several jobs at once: jobs/sec,
+  runs/sec, peak RSS and disk bytes per session
+
+Works without network access. Results are printed (or written) as JSON
+so they can be compared across versions, or across encoding profiles
+with --encoding-profile.
+
+    python benchmarks/pipeline.py --iterations 3 --output pipeline.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+# Every run must reach the browser
+os.environ.setdefault("EDGECASER_CACHE_TTL", "0")
+
+from fixture_site import PAGES, page_urls, serve  # noqa: E402
+
+from browser_pool import browser_pool  # noqa: E402
+import config  # noqa: E402
+from retention import directory_usage  # noqa: E402
+from video_encoder import ENCODING_PROFILES, encode_stage, video_filename  # noqa: E402
+from web_pw_run import load_page_with_screenshots, use_screencast  # noqa: E402
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+POST_OPTIONS = ["disableJavascript", "disableCSS", "disableImages"]
+
+
+# Resident memory of a process and all of its descendants (browsers,
+# ffmpeg), from /proc
+def tree_rss(root_pid):
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                stat = (entry / "stat").read_text()
+            except OSError:
+                continue
+            # The command name may contain spaces, fields start after ")"
+            parents[int(entry.name)] = int(stat.rsplit(")", 1)[1].split()[1])
+    pids, pending = set(), [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.add(pid)
+        pending.extend(child for child, parent in parents.items() if parent == pid)
+    total = 0
+    for pid in pids:
+        try:
+            total += int(Path(f"/proc/{pid}/statm").read_text().split()[1])
+        except OSError:
+            pass
+    return total * PAGE_SIZE
+
+
+# Samples tree_rss in the background and keeps the peak
+class RSSSampler:
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def __aenter__(self):
+        self.peak = await asyncio.to_thread(tree_rss, os.getpid())
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _sample(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            rss = await asyncio.to_thread(tree_rss, os.getpid())
+            self.peak = max(self.peak, rss)
+
+
+# Records the timestamp of every frame handed to an encoder, by output
+# path, and keeps the encoders for their timings
+class FrameProbe:
+    def __init__(self):
+        self.timestamps = {}
+        self.encoders = {}
+        self._open = None
+
+    def install(self):
+        self._open = encode_stage.open
+
+        async def open_encoder(output_path, *args, **kwargs):
+            encoder = await self._open(output_path, *args, **kwargs)
+            timestamps = self.timestamps.setdefault(str(output_path), [])
+            write = encoder.write
+
+            async def write_frame(data, timestamp):
+                timestamps.append(timestamp)
+                await write(data, timestamp)
+
+            encoder.write = write_frame
+            self.encoders[str(output_path)] = encoder
+            return encoder
+
+        encode_stage.open = open_encoder
+
+    def uninstall(self):
+        encode_stage.open = self._open
+
+
+def capture_stats(timestamps):
+    if len(timestamps) < 2:
+        return {"frames": len(timestamps), "frames_per_second": 0}
+    intervals = [
+        (later - earlier) * 1000 for earlier, later in zip(timestamps, timestamps[1:])
+    ]
+    intervals.sort()
+    return {
+        "frames": len(timestamps),
+        "frames_per_second": (len(timestamps) - 1) / (timestamps[-1] - timestamps[0]),
+        "interval_ms_median": statistics.median(intervals),
+        "interval_ms_p95": intervals[int(0.95 * (len(intervals) - 1))],
+        "jitter_ms": statistics.pstdev(intervals),
+    }
+
+
+def summarize(runs):
+    summary = {}
+    for key in dict.fromkeys(key for run in runs for key in run):
+        values = [run[key] for run in runs if run.get(key) is not None]
+        if values and all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in values
+        ):
+            summary[key] = statistics.median(values)
+    return summary
+
+
+async def bench_direct(name, url, iterations, load_duration, probe, profile):
+    runs = []
+    started = time.perf_counter()
+    for iteration in range(iterations):
+        session_id = f"bench-{name}-{iteration}"
+        run_started = time.perf_counter()
+        async with RSSSampler() as sampler:
+            artifacts = await load_page_with_screenshots(
+                session_id=session_id,
+                test_type="baseline",
+                url=url,
+                screenshot_interval=0.05,
+                load_duration=load_duration,
+                disable_js=False,
+                disable_images=False,
+                disable_css=False,
+                slow_route=False,
+                slow_network_chrome=False,
+                screen_resolution="1280x720",
+                encoding_profile=profile,
+            )
+        session_dir = Path("static/results") / session_id
+        output_path = str(session_dir / video_filename("baseline", profile))
+        encoder = probe.encoders.get(output_path)
+        runs.append(
+            {
+                "run_seconds": time.perf_counter() - run_started,
+                "video": artifacts["video"] is not None,
+                **capture_stats(probe.timestamps.get(output_path, [])),
+                "encode_seconds": getattr(encoder, "encode_seconds", None),
+                "encode_seconds_after_capture": getattr(
+                    encoder, "finish_seconds", None
+                ),
+                "video_bytes": getattr(encoder, "output_bytes", None),
+                "peak_rss_bytes": sampler.peak,
+                "disk_bytes": directory_usage(session_dir)[0],
+            }
+        )
+    elapsed = time.perf_counter() - started
+    return {
+        "runs": runs,
+        "runs_per_second": iterations / elapsed,
+        "median": summarize(runs),
+    }
+
+
+async def bench_post(urls, jobs, options, profile):
+    from app import app
+
+    async with app.test_app() as test_app, RSSSampler() as sampler:
+        client = test_app.test_client()
+        started = time.perf_counter()
+        submissions = [
+            {
+                "url": urls[index % len(urls)],
+                "options": options,
+                "force_refresh": True,
+                "encoding_profile": profile,
+            }
+            for index in range(jobs)
+        ]
+        responses = await asyncio.gather(
+            *(client.post("/api/jobs", json=data) for data in submissions)
+        )
+        status_urls = []
+        for response in responses:
+            body = await response.get_json()
+            if response.status_code != 202:
+                raise RuntimeError(f"Job rejected: {response.status_code} {body}")
+            status_urls.append(body["status_url"])
+        snapshots = {}
+        while len(snapshots) < len(status_urls):
+            await asyncio.sleep(0.2)
+            for status_url in status_urls:
+                if status_url in snapshots:
+                    continue
+                snapshot = await (await client.get(status_url)).get_json()
+                if snapshot["status"] in ("done", "failed"):
+                    snapshots[status_url] = snapshot
+        elapsed = time.perf_counter() - started
+        encoding = encode_stage.stats()
+        profile_stats = encoding["profiles"].get(profile, {})
+
+    runs = [run for snapshot in snapshots.values() for run in snapshot["runs"]]
+    disk = [
+        directory_usage(Path("static/results") / snapshot["job_id"])[0]
+        for snapshot in snapshots.values()
+    ]
+    return {
+        "jobs": jobs,
+        "runs": len(runs),
+        "failed_runs": sum(run["status"] == "failed" for run in runs),
+        "seconds": elapsed,
+        "jobs_per_second": jobs / elapsed,
+        "runs_per_second": len(runs) / elapsed,
+        "peak_rss_bytes": sampler.peak,
+        "disk_bytes_per_session": statistics.median(disk),
+        "encode_seconds_avg": encoding["encode_seconds_avg"],
+        "encode_seconds_after_capture_avg": encoding["finish_seconds_avg"],
+        "video_bytes_avg": profile_stats.get("output_bytes_avg"),
+    }
+
+
+def environment(args):
+    try:
+        revision = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        "revision": revision or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "browser_type": config.BROWSER_TYPE,
+        "capture": "screencast" if use_screencast() else "poll",
+        "encoding_profile": args.encoding_profile,
+    }
+
+
+async def run(args):
+    server = serve()
+    urls = page_urls(server)
+    pages = args.pages or list(urls)
+    results = {"environment": environment(args), "direct": {}, "post": None}
+    try:
+        if "direct" in args.flows:
+            await browser_pool.start()
+            encode_stage.start()
+            probe = FrameProbe()
+            probe.install()
+            try:
+                for name in pages:
+                    results["direct"][name] = await bench_direct(
+                        name,
+                        urls[name],
+                        args.iterations,
+                        args.load_duration,
+                        probe,
+                        args.encoding_profile,
+                    )
+            finally:
+                probe.uninstall()
+                await encode_stage.stop()
+                await browser_pool.stop()
+        if "post" in args.flows:
+            results["post"] = await bench_post(
+                [urls[name] for name in pages],
+                args.jobs,
+                args.options,
+                args.encoding_profile,
+            )
+    finally:
+        server.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", nargs="+", choices=list(PAGES))
+    parser.add_argument("--flows", nargs="+", default=["direct", "post"])
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--load-duration", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--options", nargs="+", default=POST_OPTIONS)
+    parser.add_argument(
+        "--encoding-profile",
+        choices=list(ENCODING_PROFILES),
+        default=config.ENCODING_PROFILE,
+    )
+    parser.add_argument("--output", help="Write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    output = Path(args.output).resolve() if args.output else None
+    # Results land in a scratch directory, not the app's static/results
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+    report = json.dumps(results, indent=2)
+    if output:
+        output.write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Per-request overhead of the request blocking modes.
+
+Serves a page with many small images and one stylesheet from a local
+server, blocks only the stylesheet, and times page loads with no rules,
+the old per-option route lambdas, the single route dispatcher and the
+in-browser (CDP) blocking. Every image still goes through the rules, so
+(load time - baseline) / images is the cost each request pays.
+
+    python benchmarks/request_blocking.py --images 200 --iterations 10
+
+"lambdas" is the per-request cost before the dispatcher and CDP blocking,
+"route" and "cdp" the cost after; --markdown prints them as a table.
+"""
+
+import argparse
+import asyncio
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from playwright.async_api import async_playwright  # noqa: E402
+
+from request_blocking import blocked_requests, install_request_rules  # noqa: E402
+
+# 1x1 transparent GIF
+PIXEL = bytes.fromhex(
+    "47494638396101000100800000000000ffffff21f90401000000002c00000000"
+    "010001000002024401003b"
+)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def write_fixture(root, images):
+    (root / "style.css").write_text("body { background: #eee; }")
+    for index in range(images):
+        (root / f"{index}.gif").write_bytes(PIXEL)
+    tags = "".join(f'<img src="{index}.gif">' for index in range(images))
+    (root / "index.html").write_text(
+        f'<html><head><link rel="stylesheet" href="style.css"></head>'
+        f"<body>{tags}</body></html>"
+    )
+
+
+def serve(root):
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(root))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# The handlers registered before the single dispatcher replaced them
+async def install_lambdas(context, page, resource_types, url_suffixes):
+    await context.route(
+        "**/*",
+        lambda route: (
+            route.abort()
+            if route.request.resource_type in resource_types
+            or route.request.url.endswith(tuple(url_suffixes))
+            else route.continue_()
+        ),
+    )
+
+
+async def install_rules(mode, context, page):
+    resource_types, url_suffixes = blocked_requests(False, True)
+    if mode == "lambdas":
+        await install_lambdas(context, page, resource_types, url_suffixes)
+    elif mode in ("route", "cdp"):
+        await install_request_rules(
+            context, page, resource_types, url_suffixes, mode=mode
+        )
+
+
+async def time_load(browser, mode, url):
+    context = await browser.new_context()
+    try:
+        page = await context.new_page()
+        await install_rules(mode, context, page)
+        started = time.perf_counter()
+        await page.goto(url, wait_until="load")
+        return time.perf_counter() - started
+    finally:
+        await context.close()
+
+
+async def run(images, iterations, modes):
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixture(Path(directory), images)
+        server = serve(Path(directory))
+        url = f"http://127.0.0.1:{server.server_port}/index.html"
+        async with async_playwright() as playwright:
+            browser = await playwright.chromium.launch()
+            results = {}
+            for mode in ["none", *modes]:
+                await time_load(browser, mode, url)  # warm up
+                timings = [
+                    await time_load(browser, mode, url) for _ in range(iterations)
+                ]
+                results[mode] = {"load_ms": statistics.median(timings) * 1000}
+            await browser.close()
+        server.shutdown()
+
+    baseline = results["none"]["load_ms"]
+    for result in results.values():
+        result["overhead_ms_per_request"] = (result["load_ms"] - baseline) / images
+    return results
+
+
+def markdown_table(results, images):
+    lines = [
+        f"| Mode ({images} images) | Load (ms) | Overhead per request (ms) |",
+        "| --- | ---: | ---: |",
+    ]
+    for mode, result in results.items():
+        lines.append(
+            f"| {mode} | {result['load_ms']:.1f} "
+            f"| {result['overhead_ms_per_request']:.3f} |"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--modes", nargs="+", default=["lambdas", "route", "cdp"])
+    parser.add_argument(
+        "--markdown", action="store_true", help="Print a table instead of JSON"
+    )
+    args = parser.parse_args()
+    results = asyncio.run(run(args.images, args.iterations, args.modes))
+    if args.markdown:
+        print(markdown_table(results, args.images))
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from playwright.async_api import async_playwright
+
+import config
+from logger import logger
+
+
+class PooledBrowser:
+    def __init__(self, browser):
+        self.browser = browser
+        self.active = 0
+        self.contexts_served = 0
+        self.retiring = False
+
+    def healthy(self):
+        return self.browser.is_connected()
+
+
+# Browsers send loopback hosts around a proxy by default, which would leave
+# local pages unshaped when contexts go through the network shaping proxy
+def proxy_launch_options(browser_type):
+    if browser_type == "chromium" and config.NETWORK_SHAPING == "proxy":
+        return {"args": ["--proxy-bypass-list=<-loopback>"]}
+    if browser_type == "firefox" and config.NETWORK_SHAPING != "cdp":
+        return {"firefox_user_prefs": {"network.proxy.allow_hijacking_localhost": True}}
+    return {}
+
+
+# Keeps a fixed number of warm browser processes and hands out a fresh,
+# isolated BrowserContext per run. Browsers are recycled after serving
+# max_contexts contexts and replaced when they crash or stop responding.
+class BrowserPool:
+    def __init__(
+        self,
+        size=config.BROWSER_POOL_SIZE,
+        browser_type=config.BROWSER_TYPE,
+        max_contexts=config.BROWSER_MAX_CONTEXTS,
+        health_check_interval=config.BROWSER_HEALTH_CHECK_INTERVAL,
+        launch_options=None,
+    ):
+        self.size = size
+        self.browser_type = browser_type
+        self.max_contexts = max_contexts
+        self.health_check_interval = health_check_interval
+        self.launch_options = launch_options or proxy_launch_options(browser_type)
+        self._playwright = None
+        self._browsers = []
+        self._lock = asyncio.Lock()
+        self._health_task = None
+
+    @property
+    def started(self):
+        return self._playwright is not None
+
+    async def start(self):
+        async with self._lock:
+            if self.started:
+                return
+            self._playwright = await async_playwright().start()
+            launched = await asyncio.gather(*(self._launch() for _ in range(self.size)))
+            self._browsers.extend(launched)
+        self._health_task = asyncio.create_task(self._health_check_loop())
+        logger.info(f"Browser pool started with {self.size} {self.browser_type}")
+
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        async with self._lock:
+            browsers, self._browsers = self._browsers, []
+            await asyncio.gather(
+                *(self._close(pooled) for pooled in browsers),
+                return_exceptions=True,
+            )
+            if self._playwright:
+                await self._playwright.stop()
+                self._playwright = None
+        logger.info("Browser pool stopped")
+
+    # Usage: async with browser_pool.new_context(viewport=...) as context:
+    @asynccontextmanager
+    async def new_context(self, **context_options):
+        if not self.started:
+            await self.start()
+        pooled = await self._acquire()
+        try:
+            context = await pooled.browser.new_context(**context_options)
+        except Exception:
+            await self._release(pooled)
+            raise
+        try:
+            yield context
+        finally:
+            try:
+                await context.close()
+            except Exception as e:
+                logger.info(f"Error closing browser context: {e}")
+            await self._release(pooled)
+
+    def stats(self):
+        return {
+            "browsers": len(self._browsers),
+            "active_contexts": sum(pooled.active for pooled in self._browsers),
+            "retiring": sum(pooled.retiring for pooled in self._browsers),
+        }
+
+    async def _launch(self):
+        launcher = getattr(self._playwright, self.browser_type)
+        return PooledBrowser(await launcher.launch(**self.launch_options))
+
+    async def _close(self, pooled):
+        if pooled in self._browsers:
+            self._browsers.remove(pooled)
+        if pooled.browser.is_connected():
+            await pooled.browser.close()
+
+    async def _acquire(self):
+        async with self._lock:
+            for pooled in [p for p in self._browsers if not p.healthy()]:
+                logger.info("Dropping disconnected browser from pool")
+                await self._close(pooled)
+
+            available = [p for p in self._browsers if not p.retiring]
+            # Retiring browsers are draining and do not count towards the size limit
+            if len(available) < self.size:
+                pooled = await self._launch()
+                self._browsers.append(pooled)
+            else:
+                pooled = min(available, key=lambda p: p.active)
+
+            pooled.active += 1
+            pooled.contexts_served += 1
+            if pooled.contexts_served >= self.max_contexts:
+                pooled.retiring = True
+            return pooled
+
+    async def _release(self, pooled):
+        async with self._lock:
+            pooled.active -= 1
+            if pooled.retiring and pooled.active == 0:
+                logger.info(
+                    f"Recycling browser after {pooled.contexts_served} contexts"
+                )
+                await self._close(pooled)
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self._health_check()
+            except Exception as e:
+                logger.info(f"Browser pool health check failed: {e}")
+
+    # Probe idle browsers with a throwaway context, replace any that fail,
+    # then top the pool back up to its warm size. The probes run outside
+    # the lock so a hung browser never holds up _acquire.
+    async def _health_check(self):
+        async with self._lock:
+            idle = [p for p in self._browsers if not (p.active or p.retiring)]
+        healthy = await asyncio.gather(*(self._probe(pooled) for pooled in idle))
+
+        unresponsive = []
+        async with self._lock:
+            for pooled, ok in zip(idle, healthy):
+                # Skip browsers handed out or recycled while being probed
+                if ok or pooled.active or pooled not in self._browsers:
+                    continue
+                self._browsers.remove(pooled)
+                unresponsive.append(pooled)
+
+            available = [p for p in self._browsers if not p.retiring]
+            for _ in range(self.size - len(available)):
+                self._browsers.append(await self._launch())
+
+        for pooled in unresponsive:
+            try:
+                await asyncio.wait_for(self._close(pooled), timeout=10)
+            except Exception:
+                pass
+
+    async def _probe(self, pooled):
+        try:
+            context = await asyncio.wait_for(pooled.browser.new_context(), timeout=10)
+            await context.close()
+            return True
+        except Exception as e:
+            logger.info(f"Replacing unresponsive browser: {e}")
+            return False
+
+
+browser_pool = BrowserPool()
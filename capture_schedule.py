@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import config
+from frames import FrameDeduplicator
+from logger import logger
+
+MUTATION_BINDING = "__edgecaserDomMutated"
+
+# Reports DOM mutations at most once per animation frame
+MUTATION_SCRIPT = f"""
+(() => {{
+    let pending = false;
+    const notify = () => {{
+        pending = false;
+        window.{MUTATION_BINDING}();
+    }};
+    new MutationObserver(() => {{
+        if (!pending) {{
+            pending = true;
+            requestAnimationFrame(notify);
+        }}
+    }}).observe(document, {{
+        childList: true,
+        subtree: true,
+        attributes: true,
+        characterData: true,
+    }});
+}})();
+"""
+
+
+# Decides when the polling capture takes its next screenshot. Frames are
+# taken every min_interval while the page is busy: requests in flight, the
+# last frame differed from the one before, or the page reported activity
+# (main frame commit, DOMContentLoaded, load, network idle or a DOM
+# mutation). Once it is quiet the interval doubles up to max_interval,
+# and any activity wakes the capture straight away.
+class CaptureSchedule:
+    def __init__(
+        self,
+        page,
+        min_interval,
+        max_interval=config.CAPTURE_MAX_INTERVAL_MS / 1000,
+    ):
+        self.page = page
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self.inflight = 0
+        self.frames = 0
+        self.wakeups = 0
+        self._changes = FrameDeduplicator()
+        self._activity = asyncio.Event()
+        self._listeners = {
+            "framenavigated": self._on_frame_navigated,
+            "domcontentloaded": self._wake,
+            "load": self._wake,
+            "request": self._on_request,
+            "requestfinished": self._on_request_done,
+            "requestfailed": self._on_request_done,
+        }
+
+    # Must run before navigation so the first document is observed too
+    async def install(self):
+        for event, listener in self._listeners.items():
+            self.page.on(event, listener)
+        await self.page.expose_binding(MUTATION_BINDING, self._wake)
+        await self.page.add_init_script(MUTATION_SCRIPT)
+
+    def uninstall(self):
+        for event, listener in self._listeners.items():
+            self.page.remove_listener(event, listener)
+        logger.info(
+            f"Captured {self.frames} screenshots, {self.wakeups} woken by page activity"
+        )
+
+    # Call before taking a screenshot; activity from here on counts for it
+    def begin_frame(self):
+        self._activity.clear()
+
+    # Waits until the next screenshot is due, at most until `deadline`
+    async def wait(self, frame, deadline):
+        self.frames += 1
+        changed = not self._changes.is_duplicate(frame)
+        if changed or self.inflight or self._activity.is_set():
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        await asyncio.sleep(min(self.min_interval, max(0, deadline - time.time())))
+        # The sleep above already covered min_interval of the interval
+        remaining = min(self.interval - self.min_interval, deadline - time.time())
+        if remaining > 0 and not self._activity.is_set():
+            try:
+                await asyncio.wait_for(self._activity.wait(), remaining)
+                self.wakeups += 1
+            except asyncio.TimeoutError:
+                pass
+
+    def _wake(self, *args):
+        self._activity.set()
+
+    def _on_frame_navigated(self, frame):
+        if frame == self.page.main_frame:
+            self._wake()
+
+    def _on_request(self, request):
+        self.inflight += 1
+
+    def _on_request_done(self, request):
+        self.inflight = max(0, self.inflight - 1)
+        if self.inflight == 0:
+            self._wake()
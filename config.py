@@ -0,0 +1,97 @@
+import os
+
+# Deployment settings, overridable through EDGECASER_* environment variables
+
+
+def env_int(name, default):
+    return int(os.environ.get(f"EDGECASER_{name}", default))
+
+
+def env_str(name, default):
+    return os.environ.get(f"EDGECASER_{name}", default)
+
+
+# Browser pool
+BROWSER_TYPE = env_str("BROWSER_TYPE", "chromium")
+BROWSER_POOL_SIZE = env_int("BROWSER_POOL_SIZE", 2)
+# Recycle a browser process after it has handed out this many contexts
+BROWSER_MAX_CONTEXTS = env_int("BROWSER_MAX_CONTEXTS", 50)
+BROWSER_HEALTH_CHECK_INTERVAL = env_int("BROWSER_HEALTH_CHECK_INTERVAL", 30)
+
+# Frame capture: "screencast" (Chromium CDP push), "poll" (page.screenshot
+# loop) or "auto" to use screencast whenever the pool runs Chromium
+CAPTURE_MODE = env_str("CAPTURE_MODE", "auto")
+SCREENCAST_QUALITY = env_int("SCREENCAST_QUALITY", 80)
+# Format of polled screenshots, "jpeg" (at SCREENSHOT_QUALITY) or the
+# lossless but much larger and slower to encode "png"
+SCREENSHOT_FORMAT = env_str("SCREENSHOT_FORMAT", "jpeg")
+SCREENSHOT_QUALITY = env_int("SCREENSHOT_QUALITY", 80)
+# Time between the frames of the filmstrip shown before a video is played
+FILMSTRIP_INTERVAL_MS = env_int("FILMSTRIP_INTERVAL_MS", 500)
+# Request blocking for disabled images/CSS: "cdp" (inside Chromium),
+# "route" (Playwright route handler) or "auto" to use cdp on Chromium
+REQUEST_BLOCKING = env_str("REQUEST_BLOCKING", "auto")
+# Network profiles: "cdp" (Chromium network emulation), "proxy" (local
+# shaping proxy, works with every engine) or "auto" to use cdp on Chromium
+NETWORK_SHAPING = env_str("NETWORK_SHAPING", "auto")
+# Longest gap between polled screenshots once the page is quiet (ms)
+CAPTURE_MAX_INTERVAL_MS = env_int("CAPTURE_MAX_INTERVAL_MS", 1000)
+
+# Video encoding
+VIDEO_FRAME_RATE = env_int("VIDEO_FRAME_RATE", 20)
+# Encoding profile of jobs that do not pick one (see ENCODING_PROFILES in
+# video_encoder.py): default, fast-preview, archive or webm-vp9
+ENCODING_PROFILE = env_str("ENCODING_PROFILE", "default")
+# Live ffmpeg processes allowed at once; further runs buffer frames and queue
+MAX_CONCURRENT_ENCODES = env_int("MAX_CONCURRENT_ENCODES", os.cpu_count() or 2)
+MAX_QUEUED_ENCODES = env_int("MAX_QUEUED_ENCODES", 16)
+# Frame bytes a buffering run keeps in memory. Beyond that its oldest
+# frames move to FRAME_SPILL_DIR (a tmpfs such as /dev/shm/edgecaser), or
+# without one every other frame is dropped.
+FRAME_BUFFER_MAX_BYTES = env_int("FRAME_BUFFER_MAX_BYTES", 64 * 1024**2)
+FRAME_SPILL_DIR = env_str("FRAME_SPILL_DIR", "")
+
+# HAR replayed by replay jobs instead of recording one per job, e.g. a
+# fixture so tests run without network access
+HAR_FIXTURE = env_str("HAR_FIXTURE", "")
+
+# How long finished jobs stay queryable (seconds)
+JOB_RETENTION = env_int("JOB_RETENTION", 3600)
+
+# Result cache: entries expire after CACHE_TTL seconds, least recently used
+# entries are evicted above CACHE_MAX_BYTES. Either set to 0 disables it.
+CACHE_TTL = env_int("CACHE_TTL", 6 * 3600)
+CACHE_MAX_BYTES = env_int("CACHE_MAX_BYTES", 2 * 1024**3)
+
+# Result retention: sessions older than RESULTS_MAX_AGE seconds are deleted,
+# then the oldest ones while static/results holds more than
+# RESULTS_MAX_BYTES. Either set to 0 disables that rule.
+RESULTS_MAX_AGE = env_int("RESULTS_MAX_AGE", 7 * 24 * 3600)
+RESULTS_MAX_BYTES = env_int("RESULTS_MAX_BYTES", 10 * 1024**3)
+RESULTS_GC_INTERVAL = env_int("RESULTS_GC_INTERVAL", 600)
+
+# Admission control: runs using the browser pool at once, globally and per
+# target host, and runs allowed to wait before submissions get HTTP 429
+MAX_RUNS = env_int("MAX_RUNS", 6)
+MAX_RUNS_PER_HOST = env_int("MAX_RUNS_PER_HOST", 3)
+MAX_WAITING_RUNS = env_int("MAX_WAITING_RUNS", 50)
+# Metrics-only runs skip capture and encoding, so they get their own,
+# larger limits instead of competing with video runs for MAX_RUNS
+MAX_METRICS_RUNS = env_int("MAX_METRICS_RUNS", 24)
+MAX_METRICS_RUNS_PER_HOST = env_int("MAX_METRICS_RUNS_PER_HOST", 6)
+MAX_WAITING_METRICS_RUNS = env_int("MAX_WAITING_METRICS_RUNS", 200)
+
+# Shared job store: empty runs every job inside the web process, otherwise
+# the web process only enqueues runs for worker.py processes to execute.
+# sqlite:///path/to/jobs.db for one host, redis://host:6379/0 for several.
+JOB_STORE = env_str("JOB_STORE", "")
+# A run whose worker stops sending heartbeats for LEASE_SECONDS is handed
+# to another worker, up to MAX_ATTEMPTS times in total
+LEASE_SECONDS = env_int("LEASE_SECONDS", 60)
+MAX_ATTEMPTS = env_int("MAX_ATTEMPTS", 3)
+# Seconds between store polls (idle workers and job progress)
+STORE_POLL_INTERVAL = env_int("STORE_POLL_INTERVAL", 1)
+# Runs a worker process executes at once
+WORKER_CONCURRENCY = env_int("WORKER_CONCURRENCY", MAX_RUNS)
+# Port a worker serves /metrics on (0 disables it)
+WORKER_METRICS_PORT = env_int("WORKER_METRICS_PORT", 0)
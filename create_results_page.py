@@ -1,11 +1,16 @@
+import asyncio
+
 from quart import render_template_string
 from pathlib import Path
 
+from artifacts import write_artifact
+
 
 # Create a standalone HTML file for the given session ID and results
 # Returns the relative path from 'static/' for use in 'url_for'
+# Pass the job's matrix to lay the results out as a grid
 async def create_standalone_html_file(
-    session_id, formatted_results, base_dir="static/results"
+    session_id, formatted_results, base_dir="static/results", matrix=None
 ):
     # Create a unique directory for this session under 'static/results'
     output_dir = Path(base_dir) / session_id
@@ -14,11 +19,16 @@ async def create_standalone_html_file(
     output_file_path = output_dir / "results_page.html"
 
     # Render the HTML template with results
+    results_by_run = {result["run_id"]: result for result in formatted_results}
     rendered_html = await render_template_string(
-        results_html_template, results=formatted_results
+        results_html_template,
+        results=formatted_results,
+        results_by_run=results_by_run,
+        matrix=matrix,
     )
 
-    output_file_path.write_text(rendered_html)
+    # Also writes the gzip copy served to clients that accept it
+    await asyncio.to_thread(write_artifact, output_file_path, rendered_html.encode())
 
     return output_file_path.relative_to("static").as_posix()
 
@@ -40,29 +50,115 @@ results_html_template = """
             margin: 10px;
             text-align: center;
         }
-        video {
+        video, .poster {
             width: auto;
             height: 300px;
         }
+        .matrix video, .matrix .poster {
+            height: 200px;
+        }
+        .player {
+            position: relative;
+            display: inline-block;
+            min-width: 200px;
+            min-height: 100px;
+            cursor: pointer;
+        }
+        .play {
+            position: absolute;
+            left: 50%;
+            top: 50%;
+            transform: translate(-50%, -50%);
+        }
+        .filmstrip {
+            display: block;
+            width: 480px;
+            max-width: 100%;
+            margin: 5px auto;
+        }
+        .matrix th, .matrix td {
+            border: 1px solid #ddd;
+            vertical-align: top;
+        }
+        .metrics {
+            margin: 5px auto;
+            text-align: left;
+        }
     </style>
 </head>
 <body>
     <h1>Test Results</h1>
-    <div class="gallery">
-        {% for result in results %}
-            <div class="test-result">
-                <h2>Test: {{ result.options_str }}</h2>
-                <video controls>
-                    <source height=350px width=auto src="{{ result.video_url }}" type="video/mp4">
-                    Your browser does not support the video tag.
-                </video>
-                <br>
+    {% macro result_card(result) %}
+        <div class="test-result">
+            <h2>Test: {{ result.options_str }}</h2>
+            {% if result.video_url %}
+                <div class="player" data-video="{{ result.video_url }}">
+                    <img class="poster" src="{{ result.poster_url }}" alt="Final frame" loading="lazy" onerror="this.remove()">
+                    <button type="button" class="play">&#9654; Play video</button>
+                </div>
+                <img class="filmstrip" src="{{ result.filmstrip_url }}" alt="Filmstrip, one frame every {{ result.filmstrip_interval_ms }} ms" title="One frame every {{ result.filmstrip_interval_ms }} ms" loading="lazy" onerror="this.remove()">
                 <a href="{{ result.video_url }}" download>Download Video</a>
                 <br>
-                <a href="{{ result.log_url }}" download>Download Log File</a>
-            </div>
-        {% endfor %}
-    </div>
+            {% endif %}
+            <a href="{{ result.log_url }}" download>Download Log File</a>
+            {% if result.metrics %}
+                <table class="metrics">
+                    {% for name, value in result.metrics.items() %}
+                        <tr><th>{{ name }}</th><td>{{ value }}</td></tr>
+                    {% endfor %}
+                </table>
+                <a href="{{ result.metrics_url }}" download>Download Metrics</a>
+            {% endif %}
+        </div>
+    {% endmacro %}
+    {% if matrix %}
+        <table class="matrix">
+            <tr>
+                <th></th>
+                {% for column in matrix.columns %}
+                    <th>{{ column.label }}</th>
+                {% endfor %}
+            </tr>
+            {% for option in matrix.rows %}
+                <tr>
+                    <th>{{ option }}</th>
+                    {% for run_id in matrix.cells[option] %}
+                        <td>
+                            {% if run_id in results_by_run %}
+                                {{ result_card(results_by_run[run_id]) }}
+                            {% else %}
+                                Failed
+                            {% endif %}
+                        </td>
+                    {% endfor %}
+                </tr>
+            {% endfor %}
+        </table>
+    {% else %}
+        <div class="gallery">
+            {% for result in results %}
+                {{ result_card(result) }}
+            {% endfor %}
+        </div>
+    {% endif %}
+    <script>
+        // Posters and filmstrips load first, a video only once it is played
+        document.addEventListener("click", (event) => {
+            const player = event.target.closest(".player");
+            if (!player || player.querySelector("video")) {
+                return;
+            }
+            const video = document.createElement("video");
+            video.controls = true;
+            video.autoplay = true;
+            video.src = player.dataset.video;
+            const poster = player.querySelector(".poster");
+            if (poster) {
+                video.poster = poster.src;
+            }
+            player.replaceChildren(video);
+        });
+    </script>
 </body>
 </html>
 """
@@ -0,0 +1,429 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
+from pathlib import Path
+import sqlite3
+import time
+from urllib.parse import urlsplit
+
+import config
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # Only needed for a redis:// JOB_STORE
+    redis = None
+
+
+# Queue of runs shared by the web process and the workers. The web process
+# enqueues a job's runs and polls their status; workers lease one run at a
+# time, renew the lease with heartbeats while it runs and complete it. A
+# run whose lease expires (its worker died) is handed out again until it
+# has been attempted max_attempts times.
+#
+# Run states: queued, running (leased), done, failed. Results are small
+# JSON documents, artifacts stay on the (shared) results directory.
+class JobStore(ABC):
+    def __init__(
+        self, lease_seconds=config.LEASE_SECONDS, max_attempts=config.MAX_ATTEMPTS
+    ):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    # payload describes the job (see Job.payload), runs are run specs
+    @abstractmethod
+    async def enqueue(self, payload, runs): ...
+
+    # Returns {"job": payload, "spec": spec, "attempt": n} or None
+    @abstractmethod
+    async def lease(self, worker_id): ...
+
+    # Returns False when the lease was lost to another worker
+    @abstractmethod
+    async def heartbeat(self, job_id, run_id, worker_id): ...
+
+    @abstractmethod
+    async def complete(self, job_id, run_id, worker_id, result): ...
+
+    # Puts the run back in the queue, or marks it failed after its last
+    # attempt
+    @abstractmethod
+    async def fail(self, job_id, run_id, worker_id, error): ...
+
+    # {run_id: {"status": ..., "attempts": ..., "result": ...}}
+    @abstractmethod
+    async def runs(self, job_id): ...
+
+    @abstractmethod
+    async def stats(self): ...
+
+    async def close(self):
+        pass
+
+
+def open_job_store(url=config.JOB_STORE):
+    scheme = urlsplit(url).scheme
+    if scheme == "sqlite":
+        return SQLiteJobStore(url.removeprefix("sqlite://"))
+    if scheme in ("redis", "rediss"):
+        return RedisJobStore(url)
+    raise ValueError(f"Unsupported JOB_STORE: {url}")
+
+
+LEASE_EXPIRED = json.dumps({"error": "Lease expired"})
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    job TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires REAL,
+    result TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (job_id, run_id)
+);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, lease_expires);
+"""
+
+
+# Local store for workers on the same host: sqlite:///path/to/jobs.db.
+# Every call runs in a worker thread on its own connection, and leases
+# are taken in an IMMEDIATE transaction so two processes never get the
+# same run.
+class SQLiteJobStore(JobStore):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SQLITE_SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _transaction(self, function, *args):
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                value = function(connection, *args)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return value
+        finally:
+            connection.close()
+
+    async def _run(self, function, *args):
+        return await asyncio.to_thread(self._transaction, function, *args)
+
+    async def enqueue(self, payload, runs):
+        def insert(connection):
+            now = time.time()
+            # Finished runs are only kept as long as their results
+            connection.execute(
+                "DELETE FROM runs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (now - config.RESULTS_MAX_AGE,),
+            )
+            connection.executemany(
+                "INSERT INTO runs (job_id, run_id, job, spec, status, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                [
+                    (
+                        payload["job_id"],
+                        spec["run_id"],
+                        json.dumps(payload),
+                        json.dumps(spec),
+                        now,
+                    )
+                    for spec in runs
+                ],
+            )
+
+        await self._run(insert)
+
+    async def lease(self, worker_id):
+        def take(connection):
+            now = time.time()
+            # Leases of dead workers: out of attempts means failed
+            connection.execute(
+                "UPDATE runs SET status = 'failed', worker_id = NULL, updated_at = ?, "
+                "result = ? WHERE status = 'running' AND lease_expires < ? "
+                "AND attempts >= ?",
+                (now, LEASE_EXPIRED, now, self.max_attempts),
+            )
+            row = connection.execute(
+                "SELECT seq, job, spec, attempts FROM runs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?) "
+                "ORDER BY seq LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE runs SET status = 'running', worker_id = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE seq = ?",
+                (worker_id, now + self.lease_seconds, now, row["seq"]),
+            )
+            return {
+                "job": json.loads(row["job"]),
+                "spec": json.loads(row["spec"]),
+                "attempt": row["attempts"] + 1,
+            }
+
+        return await self._run(take)
+
+    async def heartbeat(self, job_id, run_id, worker_id):
+        def renew(connection):
+            now = time.time()
+            cursor = connection.execute(
+                "UPDATE runs SET lease_expires = ?, updated_at = ? "
+                "WHERE job_id = ? AND run_id = ? AND worker_id = ? AND status = 'running'",
+                (now + self.lease_seconds, now, job_id, run_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+        return await self._run(renew)
+
+    async def complete(self, job_id, run_id, worker_id, result):
+        await self._finish(job_id, run_id, worker_id, "done", result)
+
+    async def fail(self, job_id, run_id, worker_id, error):
+        await self._finish(job_id, run_id, worker_id, "failed", {"error": error})
+
+    async def _finish(self, job_id, run_id, worker_id, status, result):
+        def finish(connection):
+            row = connection.execute(
+                "SELECT attempts FROM runs WHERE job_id = ? AND run_id = ? "
+                "AND worker_id = ? AND status = 'running'",
+                (job_id, run_id, worker_id),
+            ).fetchone()
+            if row is None:
+                return  # Lease lost, the run belongs to another worker now
+            final = status
+            if status == "failed" and row["attempts"] < self.max_attempts:
+                final = "queued"
+            connection.execute(
+                "UPDATE runs SET status = ?, worker_id = NULL, lease_expires = NULL, "
+                "result = ?, updated_at = ? WHERE job_id = ? AND run_id = ?",
+                (final, json.dumps(result), time.time(), job_id, run_id),
+            )
+
+        await self._run(finish)
+
+    async def runs(self, job_id):
+        def select(connection):
+            rows = connection.execute(
+                "SELECT run_id, status, attempts, result FROM runs WHERE job_id = ?",
+                (job_id,),
+            ).fetchall()
+            return {
+                row["run_id"]: {
+                    "status": row["status"],
+                    "attempts": row["attempts"],
+                    "result": json.loads(row["result"]) if row["result"] else None,
+                }
+                for row in rows
+            }
+
+        return await self._run(select)
+
+    async def stats(self):
+        def count(connection):
+            rows = connection.execute(
+                "SELECT status, COUNT(*) AS runs FROM runs GROUP BY status"
+            ).fetchall()
+            return {row["status"]: row["runs"] for row in rows}
+
+        return {"backend": "sqlite", "runs": await self._run(count)}
+
+
+# Store for workers on several hosts: redis://host:6379/0 (anything that
+# speaks the Redis protocol). Queued run keys sit in a list, running ones
+# in a sorted set scored by lease expiry; whoever removes an expired
+# lease from the set is the one that requeues it.
+# Hands expired leases back (or fails runs out of attempts), then pops the
+# next run whose job still exists and leases it, all in one atomic step so
+# a worker dying mid-lease cannot lose a run or requeue it twice.
+# KEYS: queue, leases. ARGV: now, lease expiry, worker id, max attempts,
+# LEASE_EXPIRED, key prefix. Returns {attempts, spec, payload} or nil.
+LEASE_SCRIPT = """
+local expired = redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", ARGV[1])
+for _, key in ipairs(expired) do
+    redis.call("ZREM", KEYS[2], key)
+    if redis.call("EXISTS", key) == 1 then
+        local attempts = tonumber(redis.call("HGET", key, "attempts") or "0")
+        if attempts >= tonumber(ARGV[4]) then
+            redis.call("HSET", key, "status", "failed", "worker_id", "",
+                "result", ARGV[5])
+        else
+            redis.call("HSET", key, "status", "queued", "worker_id", "")
+            redis.call("LPUSH", KEYS[1], key)
+        end
+    end
+end
+while true do
+    local key = redis.call("LPOP", KEYS[1])
+    if not key then
+        return nil
+    end
+    local job_id = redis.call("HGET", key, "job_id")
+    local payload = job_id and redis.call("HGET", ARGV[6] .. ":job:" .. job_id,
+        "payload")
+    if payload then
+        redis.call("HSET", key, "status", "running", "worker_id", ARGV[3])
+        local attempts = redis.call("HINCRBY", key, "attempts", 1)
+        redis.call("ZADD", KEYS[2], ARGV[2], key)
+        return {attempts, redis.call("HGET", key, "spec"), payload}
+    end
+end
+"""
+
+# Ends a leased run if worker ARGV[1] still holds it: stores the status
+# and result, requeueing failed runs with attempts left. KEYS: queue,
+# leases, run. ARGV: worker id, status, result, max attempts.
+FINISH_SCRIPT = """
+if redis.call("HGET", KEYS[3], "worker_id") ~= ARGV[1] then
+    return 0
+end
+if redis.call("ZREM", KEYS[2], KEYS[3]) == 0 then
+    return 0
+end
+local attempts = tonumber(redis.call("HGET", KEYS[3], "attempts") or "0")
+local requeue = ARGV[2] == "failed" and attempts < tonumber(ARGV[4])
+redis.call("HSET", KEYS[3], "status", requeue and "queued" or ARGV[2],
+    "worker_id", "", "result", ARGV[3])
+if requeue then
+    redis.call("RPUSH", KEYS[1], KEYS[3])
+end
+return 1
+"""
+
+
+class RedisJobStore(JobStore):
+    prefix = "edgecaser"
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        if redis is None:
+            raise RuntimeError(
+                "A redis:// JOB_STORE needs the redis package (requirements-redis.txt)"
+            )
+        self.client = redis.from_url(url, decode_responses=True)
+        self.queue_key = f"{self.prefix}:queue"
+        self.leases_key = f"{self.prefix}:leases"
+        self._lease = self.client.register_script(LEASE_SCRIPT)
+        self._finish_run = self.client.register_script(FINISH_SCRIPT)
+
+    def _run_key(self, job_id, run_id):
+        return f"{self.prefix}:run:{job_id}:{run_id}"
+
+    def _job_key(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    async def enqueue(self, payload, runs):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(self._job_key(payload["job_id"]), "payload", json.dumps(payload))
+            for spec in runs:
+                key = self._run_key(payload["job_id"], spec["run_id"])
+                pipe.hset(
+                    key,
+                    mapping={
+                        "job_id": payload["job_id"],
+                        "spec": json.dumps(spec),
+                        "status": "queued",
+                        "attempts": 0,
+                    },
+                )
+                pipe.rpush(f"{self._job_key(payload['job_id'])}:runs", spec["run_id"])
+                pipe.rpush(self.queue_key, key)
+                pipe.expire(key, config.RESULTS_MAX_AGE)
+            pipe.expire(self._job_key(payload["job_id"]), config.RESULTS_MAX_AGE)
+            pipe.expire(
+                f"{self._job_key(payload['job_id'])}:runs", config.RESULTS_MAX_AGE
+            )
+            await pipe.execute()
+
+    async def lease(self, worker_id):
+        now = time.time()
+        leased = await self._lease(
+            keys=[self.queue_key, self.leases_key],
+            args=[
+                now,
+                now + self.lease_seconds,
+                worker_id,
+                self.max_attempts,
+                LEASE_EXPIRED,
+                self.prefix,
+            ],
+        )
+        if leased is None:
+            return None
+        attempts, spec, payload = leased
+        return {
+            "job": json.loads(payload),
+            "spec": json.loads(spec),
+            "attempt": int(attempts),
+        }
+
+    async def heartbeat(self, job_id, run_id, worker_id):
+        key = self._run_key(job_id, run_id)
+        if await self.client.hget(key, "worker_id") != worker_id:
+            return False
+        expires = time.time() + self.lease_seconds
+        return bool(
+            await self.client.zadd(self.leases_key, {key: expires}, xx=True, ch=True)
+        )
+
+    async def complete(self, job_id, run_id, worker_id, result):
+        await self._finish(job_id, run_id, worker_id, "done", result)
+
+    async def fail(self, job_id, run_id, worker_id, error):
+        await self._finish(job_id, run_id, worker_id, "failed", {"error": error})
+
+    async def _finish(self, job_id, run_id, worker_id, status, result):
+        await self._finish_run(
+            keys=[
+                self.queue_key,
+                self.leases_key,
+                self._run_key(job_id, run_id),
+            ],
+            args=[worker_id, status, json.dumps(result), self.max_attempts],
+        )
+
+    async def runs(self, job_id):
+        run_ids = await self.client.lrange(f"{self._job_key(job_id)}:runs", 0, -1)
+        runs = {}
+        for run_id in run_ids:
+            run = await self.client.hgetall(self._run_key(job_id, run_id))
+            if not run:
+                continue  # Expired after RESULTS_MAX_AGE
+            runs[run_id] = {
+                "status": run["status"],
+                "attempts": int(run["attempts"]),
+                "result": json.loads(run["result"]) if run.get("result") else None,
+            }
+        return runs
+
+    async def stats(self):
+        return {
+            "backend": "redis",
+            "runs": {
+                "queued": await self.client.llen(self.queue_key),
+                "running": await self.client.zcard(self.leases_key),
+            },
+        }
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,338 @@
+import asyncio
+import re
+import time
+from urllib.parse import urlsplit
+
+import config
+from logger import logger, set_log_context
+from telemetry import RUNS, STAGE_SECONDS, StageTimer
+
+
+def slug(text):
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+
+
+# One run of a job: a test option under a network profile (None for no
+# throttling) at a screen resolution. run_id also names the run's files.
+def run_spec(option, network_profile, resolution, run_id=None):
+    if run_id is None:
+        profile = slug(network_profile) if network_profile else "unthrottled"
+        run_id = f"{option}-{profile}-{resolution}"
+    return {
+        "run_id": run_id,
+        "option": option,
+        "network_profile": network_profile,
+        "resolution": resolution,
+    }
+
+
+def resolution_pixels(resolution):
+    width, height = map(int, resolution.split("x"))
+    return width * height
+
+
+# Expands option x network profile x resolution into runs. Returns the runs
+# in scheduling order and the grid used to lay out the results page.
+# Runs are started largest viewport first (longest processing time first),
+# so the expensive screenshots and encodes overlap with the cheap ones
+# instead of being left for the end of the job.
+def expand_matrix(options, network_profiles, resolutions):
+    columns = []
+    cells = {option: [] for option in options}
+    runs = []
+    for network_profile in network_profiles:
+        for resolution in resolutions:
+            columns.append(
+                {
+                    "label": f"{network_profile or 'No throttling'} {resolution}",
+                    "network_profile": network_profile,
+                    "resolution": resolution,
+                }
+            )
+            for option in options:
+                spec = run_spec(option, network_profile, resolution)
+                cells[option].append(spec["run_id"])
+                runs.append(spec)
+    runs.sort(key=lambda spec: resolution_pixels(spec["resolution"]), reverse=True)
+    return runs, {"rows": options, "columns": columns, "cells": cells}
+
+
+# A submitted test made of runs (see run_spec). Progress events are pushed
+# to every subscriber queue (one per open results websocket).
+class Job:
+    def __init__(
+        self,
+        job_id,
+        url,
+        runs,
+        results,
+        results_page_url,
+        force_refresh=False,
+        matrix=None,
+        metrics_only=False,
+        replay=False,
+        encoding_profile=config.ENCODING_PROFILE,
+    ):
+        self.job_id = job_id
+        self.url = url
+        self.host = (urlsplit(url).hostname or "").lower()
+        self.specs = {spec["run_id"]: spec for spec in runs}
+        self.run_ids = list(self.specs)
+        # Artifact URLs per run, resolved when the job is submitted
+        self.results = dict(zip(self.run_ids, results))
+        self.runs = {run_id: "queued" for run_id in self.run_ids}
+        # Grid layout from expand_matrix, None for a plain list of options
+        self.matrix = matrix
+        # Skip the result cache and always run the browser
+        self.force_refresh = force_refresh
+        # Only collect page metrics, no screenshots or video
+        self.metrics_only = metrics_only
+        # Replay every run from one recorded HAR instead of the live site
+        self.replay = replay
+        # Name of the video encoding profile (see ENCODING_PROFILES)
+        self.encoding_profile = encoding_profile
+        # Task recording that HAR, shared by the runs
+        self.har_recording = None
+        self.cached = set()
+        self.status = "queued"
+        self.results_page_url = results_page_url
+        self.results_url = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._subscribers = set()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    # What a worker needs to run the job's runs (see JobStore)
+    def payload(self):
+        return {
+            "job_id": self.job_id,
+            "url": self.url,
+            "force_refresh": self.force_refresh,
+            "metrics_only": self.metrics_only,
+            "replay": self.replay,
+            "encoding_profile": self.encoding_profile,
+        }
+
+    # The worker side of a job: results are filled in run by run
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(
+            payload["job_id"],
+            payload["url"],
+            [],
+            [],
+            None,
+            force_refresh=payload["force_refresh"],
+            metrics_only=payload["metrics_only"],
+            replay=payload["replay"],
+            # Absent from runs enqueued before profiles existed
+            encoding_profile=payload.get("encoding_profile", config.ENCODING_PROFILE),
+        )
+
+    # What a run adds to its result, sent back by workers
+    def run_result(self, run_id):
+        return {
+            "cached": run_id in self.cached,
+            "metrics": self.results[run_id].get("metrics"),
+            "timings": self.results[run_id].get("timings"),
+            "memory": self.results[run_id].get("memory"),
+        }
+
+    # store_wait: seconds the run spent in the shared queue before a
+    # worker leased it
+    def apply_run_result(self, run_id, result, store_wait=0):
+        if result.get("cached"):
+            self.cached.add(run_id)
+        timings = result.get("timings") or {}
+        timings["store_wait"] = round(store_wait, 3)
+        self.results[run_id]["metrics"] = result.get("metrics")
+        self.results[run_id]["timings"] = timings
+        self.results[run_id]["memory"] = result.get("memory")
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event):
+        for queue in self._subscribers:
+            queue.put_nowait(event)
+
+    def update_run(self, run_id, status):
+        self.runs[run_id] = status
+        self.publish(self.run_event(run_id))
+
+    def finish(self, results_url):
+        failed = all(status == "failed" for status in self.runs.values())
+        self.status = "failed" if failed else "done"
+        self.results_url = results_url
+        self.finished_at = time.time()
+        self.publish(self.job_event())
+
+    def run_event(self, run_id):
+        return {
+            "type": "run",
+            **self.specs[run_id],
+            "status": self.runs[run_id],
+            "cached": run_id in self.cached,
+            "result": self.results[run_id],
+        }
+
+    def job_event(self):
+        return {
+            "type": "job",
+            "job_id": self.job_id,
+            "status": self.status,
+            "results_url": self.results_url,
+        }
+
+    def snapshot(self):
+        return {
+            **self.job_event(),
+            "url": self.url,
+            "matrix": self.matrix,
+            "metrics_only": self.metrics_only,
+            "replay": self.replay,
+            "encoding_profile": self.encoding_profile,
+            "runs": [self.run_event(run_id) for run_id in self.run_ids],
+        }
+
+
+# Holds submitted jobs and runs every run as its own task once the
+# AdmissionController grants it a slot, so submitting returns immediately
+# and a busy target host never holds up runs for other hosts. Tasks are
+# created in the job's run order, which is the order slots are granted.
+# run_option(job, spec) performs a single run; finish_job(job) is awaited
+# once every run has ended and returns the URL of the results page.
+# Metrics-only jobs are admitted by metrics_admission when one is given.
+# With a JobStore the runs are enqueued for worker processes instead, and
+# the job follows their progress by polling the store.
+class JobManager:
+    def __init__(
+        self,
+        run_option,
+        finish_job,
+        admission,
+        metrics_admission=None,
+        store=None,
+        poll_interval=config.STORE_POLL_INTERVAL,
+    ):
+        self.run_option = run_option
+        self.finish_job = finish_job
+        self.admission = admission
+        self.metrics_admission = metrics_admission or admission
+        self.store = store
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self._tasks = set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # Raises AdmissionRejected when the run queue cannot take the job
+    def submit(self, job):
+        self.admission_for(job).reserve(len(job.run_ids))
+        self._prune()
+        self.jobs[job.job_id] = job
+        if self.store:
+            coroutines = [self._watch(job)]
+        else:
+            coroutines = [self._run(job, run_id) for run_id in job.run_ids]
+        for coroutine in coroutines:
+            task = asyncio.create_task(coroutine)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        logger.info(f"Queued job {job.job_id} with {len(job.run_ids)} runs")
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def admission_for(self, job):
+        return self.metrics_admission if job.metrics_only else self.admission
+
+    # Forget finished jobs after JOB_RETENTION seconds
+    def _prune(self):
+        cutoff = time.time() - config.JOB_RETENTION
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                del self.jobs[job_id]
+
+    async def _run(self, job, run_id):
+        set_log_context(job.job_id, run_id)
+        timer = StageTimer()
+        queued_at = time.perf_counter()
+        async with self.admission_for(job).slot(job.host):
+            timer.record("queue_wait", time.perf_counter() - queued_at)
+            job.status = "running"
+            job.update_run(run_id, "running")
+            try:
+                await self.run_option(job, job.specs[run_id], timer)
+                job.update_run(run_id, "done")
+            except Exception as e:
+                logger.info(f"Run {run_id} of job {job.job_id} failed: {e}")
+                job.update_run(run_id, "failed")
+            RUNS.labels(job.runs[run_id]).inc()
+
+        if all(status in ("done", "failed") for status in job.runs.values()):
+            # Job-level lines belong to the job, not to whichever run ended last
+            set_log_context(job.job_id)
+            await self._finish(job)
+
+    # Enqueues the job's runs and mirrors their status from the store.
+    # Runs stay reserved with the admission controller until a worker
+    # picks them up, so the web process still answers 429 when the shared
+    # queue backs up. The other stages are timed by the workers, this
+    # process only times the wait in the shared queue (store_wait).
+    async def _watch(self, job):
+        set_log_context(job.job_id)
+        admission = self.admission_for(job)
+        waiting = set(job.run_ids)
+        store_waits = {}
+        try:
+            await self.store.enqueue(
+                job.payload(), [job.specs[run_id] for run_id in job.run_ids]
+            )
+            while not all(status in ("done", "failed") for status in job.runs.values()):
+                await asyncio.sleep(self.poll_interval)
+                for run_id, run in (await self.store.runs(job.job_id)).items():
+                    if run["status"] != "queued" and run_id in waiting:
+                        waiting.discard(run_id)
+                        admission.cancel(1)
+                        store_waits[run_id] = time.time() - job.created_at
+                        STAGE_SECONDS.labels("store_wait").observe(store_waits[run_id])
+                    if run["status"] == job.runs[run_id]:
+                        continue
+                    if run["status"] == "done":
+                        job.apply_run_result(
+                            run_id, run["result"], store_waits.get(run_id, 0)
+                        )
+                    elif run["status"] == "running":
+                        job.status = "running"
+                    job.update_run(run_id, run["status"])
+                    if run["status"] in ("done", "failed"):
+                        RUNS.labels(run["status"]).inc()
+        except Exception as e:
+            logger.info(f"Lost track of job {job.job_id}: {e}")
+            for run_id, status in job.runs.items():
+                if status not in ("done", "failed"):
+                    job.update_run(run_id, "failed")
+        finally:
+            admission.cancel(len(waiting))
+        await self._finish(job)
+
+    async def _finish(self, job):
+        try:
+            results_url = await self.finish_job(job)
+        except Exception as e:
+            logger.info(f"Could not finish job {job.job_id}: {e}")
+            results_url = None
+        job.finish(results_url)
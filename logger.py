@@ -1,6 +1,47 @@
+import atexit
+import contextvars
 import logging
+import logging.handlers
+import queue
 
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s"
+# Session (job) and run the current task is working on. Every run is its
+# own asyncio task, so setting them inside the task only affects the log
+# lines of that run.
+session_id = contextvars.ContextVar("session_id", default=None)
+run_id = contextvars.ContextVar("run_id", default=None)
+
+
+def set_log_context(session, run=None):
+    session_id.set(session)
+    run_id.set(run)
+
+
+# Adds the session and run to records while still on the logging thread
+# (the event loop), before they are handed to the listener
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.session_id = session_id.get()
+        record.run_id = run_id.get()
+        parts = [part for part in (record.session_id, record.run_id) if part]
+        record.context = f" [{'/'.join(parts)}]" if parts else ""
+        return True
+
+
+# Records only go through a queue on the event loop; formatting and the
+# write to stderr happen on the QueueListener thread
+_records = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s]%(context)s %(message)s")
 )
+_queue_handler = logging.handlers.QueueHandler(_records)
+# Only merges the message arguments, the listener's handler does the rest
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+_queue_handler.addFilter(ContextFilter())
+_listener = logging.handlers.QueueListener(_records, _stream_handler)
+
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+_listener.start()
+atexit.register(_listener.stop)
+
 logger = logging.getLogger(__name__)
@@ -0,0 +1,398 @@
+import asyncio
+from contextlib import asynccontextmanager
+import itertools
+import json
+import math
+from pathlib import Path
+import random
+import sys
+import time
+
+from browser_pool import browser_pool
+import config
+from logger import logger
+
+CHUNK_SIZE = 16 * 1024
+# Payload of one TCP segment, used to turn packet loss into chunk loss
+SEGMENT_SIZE = 1460
+MAX_HEADER_BYTES = 64 * 1024
+# Chunks buffered per direction before reads from the sender pause
+QUEUE_CHUNKS = 64
+HOP_BY_HOP_HEADERS = (b"connection", b"proxy-connection", b"proxy-authorization")
+# Seconds between the stats snapshots the proxy process sends
+STATS_INTERVAL = 1
+
+
+# "cdp" (Chromium network emulation), "proxy" (ShapingProxy) or "auto"
+# to use cdp on Chromium and the proxy for other engines
+def shaping_mode():
+    if config.NETWORK_SHAPING == "auto":
+        return "cdp" if browser_pool.browser_type == "chromium" else "proxy"
+    return config.NETWORK_SHAPING
+
+
+# Limits a byte stream to `rate` bytes per second (0 for unlimited). The
+# bucket is a virtual clock of when the link is next free, so any number
+# of connections can share it without a lock and are served in order.
+class TokenBucket:
+    def __init__(self, rate, burst_seconds=0.05):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self._free_at = 0
+
+    async def consume(self, size):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._free_at = max(self._free_at, now - self.burst_seconds)
+        self._free_at += size / self.rate
+        if self._free_at > now:
+            await asyncio.sleep(self._free_at - now)
+
+
+# The shaped network of one run: bandwidth shared by all its connections,
+# latency split over both directions, jitter, and packet loss emulated as
+# the retransmission delay a lost segment costs
+class ShapingLane:
+    def __init__(self, conditions):
+        self.latency = conditions["latency"] / 1000
+        self.jitter = conditions.get("jitter", 0) / 1000
+        self.packet_loss = conditions.get("packetLoss", 0)
+        self.download = TokenBucket(conditions["downloadThroughput"])
+        self.upload = TokenBucket(conditions["uploadThroughput"])
+        self.server = None
+        self.connections = set()
+        self.bytes_down = 0
+        self.bytes_up = 0
+
+    def one_way_delay(self, size):
+        delay = self.latency / 2 + random.uniform(-self.jitter, self.jitter) / 2
+        if self.packet_loss:
+            segments = math.ceil(size / SEGMENT_SIZE)
+            if random.random() < 1 - (1 - self.packet_loss) ** segments:
+                delay += max(0.2, 2 * self.latency)
+        return max(0, delay)
+
+
+# HTTP/HTTPS forward proxy shaping the traffic of browser contexts. It
+# runs in the shaping proxy process (see serve_lanes), so pumping hundreds
+# of shaped connections never competes with frame capture on the app's
+# event loop. Every run gets a lane with its own listening port; plain
+# HTTP requests are forwarded one per connection and HTTPS goes through
+# CONNECT tunnels, shaped byte for byte without decrypting.
+class ShapingServer:
+    def __init__(self, host="127.0.0.1"):
+        self.host = host
+        self.lanes = {}
+        self.connections_total = 0
+        self.bytes_down = 0
+        self.bytes_up = 0
+
+    # Returns the port of a new lane shaped by conditions
+    async def open_lane(self, conditions):
+        lane = ShapingLane(conditions)
+        lane.server = await asyncio.start_server(
+            lambda reader, writer: self._handle(lane, reader, writer),
+            self.host,
+            0,
+            limit=MAX_HEADER_BYTES,
+        )
+        port = lane.server.sockets[0].getsockname()[1]
+        self.lanes[port] = lane
+        return port
+
+    async def close_lane(self, port):
+        lane = self.lanes.pop(port, None)
+        if lane is None:
+            return
+        lane.server.close()
+        for writer in list(lane.connections):
+            writer.close()
+        await lane.server.wait_closed()
+        self.bytes_down += lane.bytes_down
+        self.bytes_up += lane.bytes_up
+
+    async def close(self):
+        await asyncio.gather(*(self.close_lane(port) for port in list(self.lanes)))
+
+    def stats(self):
+        lanes = self.lanes.values()
+        return {
+            "lanes": len(lanes),
+            "connections": sum(len(lane.connections) for lane in lanes),
+            "connections_total": self.connections_total,
+            "bytes_down": self.bytes_down + sum(lane.bytes_down for lane in lanes),
+            "bytes_up": self.bytes_up + sum(lane.bytes_up for lane in lanes),
+        }
+
+    async def _handle(self, lane, reader, writer):
+        self.connections_total += 1
+        lane.connections.add(writer)
+        upstream_writer = None
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            method, target, version = head.split(b"\r\n", 1)[0].split(b" ", 2)
+            if method == b"CONNECT":
+                host, port = split_host_port(target.decode(), 443)
+            else:
+                host, port, head = rewrite_request(head, method, target, version)
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection(
+                    host, port
+                )
+            except OSError:
+                writer.write(b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            # Connection setup costs a round trip
+            await asyncio.sleep(lane.latency)
+            if method == b"CONNECT":
+                writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+                await writer.drain()
+            else:
+                await lane.upload.consume(len(head))
+                upstream_writer.write(head)
+                lane.bytes_up += len(head)
+            upload = asyncio.create_task(
+                self._pump(lane, reader, upstream_writer, upload=True)
+            )
+            # Once the server is done nothing the client sends matters
+            try:
+                await self._pump(lane, upstream_reader, writer, upload=False)
+            finally:
+                upload.cancel()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass  # Client closed or sent something that is not HTTP
+        except Exception as e:
+            logger.info(f"Shaping proxy connection failed: {e}")
+        finally:
+            lane.connections.discard(writer)
+            for stream in (writer, upstream_writer):
+                if stream is not None:
+                    stream.close()
+
+    # Copies one direction of a connection through the lane's bandwidth
+    # limit and a delay line that keeps chunks in order
+    async def _pump(self, lane, reader, writer, upload):
+        bucket = lane.upload if upload else lane.download
+        queue = asyncio.Queue(QUEUE_CHUNKS)
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+                if upload:
+                    lane.bytes_up += len(data)
+                else:
+                    lane.bytes_down += len(data)
+            if writer.can_write_eof():
+                writer.write_eof()
+
+        delivery = asyncio.create_task(deliver())
+        last_due = 0
+        try:
+            while data := await reader.read(CHUNK_SIZE):
+                if delivery.done():
+                    break  # The receiving side went away
+                await bucket.consume(len(data))
+                due = time.monotonic() + lane.one_way_delay(len(data))
+                last_due = max(last_due, due)
+                await queue.put((last_due, data))
+            else:
+                await queue.put((last_due, None))
+            await delivery
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            delivery.cancel()
+
+
+def split_host_port(authority, default_port):
+    host, _, port = authority.rpartition(":")
+    if not host or not port.isdigit():
+        return authority.strip("[]"), default_port
+    return host.strip("[]"), int(port)
+
+
+# Turns an absolute-form proxy request into an origin-form one for the
+# target server, one request per connection
+def rewrite_request(head, method, target, version):
+    url = target.decode()
+    if not url.startswith("http://"):
+        raise ValueError(f"Unsupported proxy request target: {url}")
+    authority, _, path = url.removeprefix("http://").partition("/")
+    host, port = split_host_port(authority, 80)
+    lines = [b" ".join((method, b"/" + path.encode(), version))]
+    for line in head.split(b"\r\n")[1:]:
+        name = line.split(b":", 1)[0].strip().lower()
+        if line and name not in HOP_BY_HOP_HEADERS:
+            lines.append(line)
+    lines.append(b"Connection: close")
+    return host, port, b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+# A lane of the shaping proxy process, as handed to a run
+class ProxyLane:
+    def __init__(self, port, proxy):
+        self.port = port
+        # Playwright proxy settings for the run's browser context
+        self.proxy = proxy
+
+
+# Client side of the shaping proxy process, used by the app and workers.
+# The process is started on the first lane and restarted if it exits;
+# lanes are opened and closed with JSON lines on its stdin, replies and
+# stats snapshots come back on its stdout.
+class ShapingProxy:
+    def __init__(self, host="127.0.0.1"):
+        self.host = host
+        self.process = None
+        self._reader = None
+        self._pending = {}
+        self._ids = itertools.count()
+        self._start_lock = asyncio.Lock()
+        self._stats = ShapingServer(host).stats()
+
+    # Usage: async with shaping_proxy.lane(conditions) as lane:
+    #            browser.new_context(proxy=lane.proxy)
+    # Yields None when conditions is None
+    @asynccontextmanager
+    async def lane(self, conditions):
+        if conditions is None:
+            yield None
+            return
+        port = (await self._call({"op": "open", "conditions": conditions}))["port"]
+        proxy = {"server": f"http://{self.host}:{port}"}
+        if browser_pool.browser_type == "chromium":
+            # Chromium sends loopback hosts around the proxy unless told not to
+            proxy["bypass"] = "<-loopback>"
+        try:
+            yield ProxyLane(port, proxy)
+        finally:
+            try:
+                await self._call({"op": "close", "port": port})
+            except ConnectionError:
+                pass  # The process exited and took the lane with it
+
+    def stats(self):
+        return {
+            "mode": shaping_mode(),
+            "pid": self.process.pid if self.process else None,
+            **self._stats,
+        }
+
+    async def stop(self):
+        process = self.process
+        if process is None:
+            return
+        self.process = None
+        process.stdin.close()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+        await self._reader
+
+    async def _call(self, request):
+        process = await self._ensure_started()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            process.stdin.write(json.dumps({"id": request_id, **request}).encode())
+            process.stdin.write(b"\n")
+            await process.stdin.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _ensure_started(self):
+        async with self._start_lock:
+            if self.process is None:
+                self.process = await asyncio.create_subprocess_exec(
+                    sys.executable,
+                    str(Path(__file__).resolve()),
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                )
+                self._reader = asyncio.create_task(self._read(self.process))
+                logger.info(f"Started shaping proxy process {self.process.pid}")
+            return self.process
+
+    async def _read(self, process):
+        try:
+            while line := await process.stdout.readline():
+                message = json.loads(line)
+                if "stats" in message:
+                    self._stats = message["stats"]
+                    continue
+                future = self._pending.get(message["id"])
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(RuntimeError(message["error"]))
+                else:
+                    future.set_result(message)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError("Shaping proxy process exited")
+                    )
+            if self.process is process:
+                logger.info("Shaping proxy process exited, restarting on next lane")
+                self.process = None
+
+
+# Main loop of the shaping proxy process: answers open/close requests read
+# from stdin and pushes a stats snapshot every STATS_INTERVAL seconds.
+# Exits once stdin closes (the parent stopped or died).
+async def serve_lanes():
+    server = ShapingServer()
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+    )
+
+    def send(message):
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+    async def answer(request):
+        reply = {"id": request["id"]}
+        try:
+            if request["op"] == "open":
+                reply["port"] = await server.open_lane(request["conditions"])
+            else:
+                await server.close_lane(request["port"])
+        except Exception as e:
+            reply["error"] = str(e)
+        send(reply)
+
+    async def push_stats():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            send({"stats": server.stats()})
+
+    tasks = {asyncio.create_task(push_stats())}
+    while line := await reader.readline():
+        task = asyncio.create_task(answer(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    for task in tasks:
+        task.cancel()
+    await server.close()
+
+
+shaping_proxy = ShapingProxy()
+
+if __name__ == "__main__":
+    asyncio.run(serve_lanes())
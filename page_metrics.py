@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+from artifacts import write_artifact
+from logger import logger
+
+# Registered before any page script runs. Long tasks are not buffered by
+# the browser, so they have to be observed from the start; paint, LCP and
+# layout shifts are recorded here too and re-read when the run ends.
+METRICS_INIT_SCRIPT = """
+(() => {
+    const metrics = { longTasks: [], layoutShifts: [], lcp: null };
+    window.__edgecaserMetrics = metrics;
+    const observe = (type, callback) => {
+        try {
+            new PerformanceObserver((list) => list.getEntries().forEach(callback))
+                .observe({ type, buffered: true });
+        } catch (e) {
+            // Entry type not supported by this browser
+        }
+    };
+    observe("longtask", (entry) => {
+        metrics.longTasks.push({ startTime: entry.startTime, duration: entry.duration });
+    });
+    observe("layout-shift", (entry) => {
+        if (!entry.hadRecentInput) {
+            metrics.layoutShifts.push({ startTime: entry.startTime, value: entry.value });
+        }
+    });
+    observe("largest-contentful-paint", (entry) => {
+        metrics.lcp = entry.startTime;
+    });
+})();
+"""
+
+COLLECT_METRICS_SCRIPT = """
+() => {
+    const observed = window.__edgecaserMetrics || { longTasks: [], layoutShifts: [], lcp: null };
+    const [navigation] = performance.getEntriesByType("navigation");
+    const paint = {};
+    performance.getEntriesByType("paint").forEach((entry) => {
+        paint[entry.name] = entry.startTime;
+    });
+
+    // CLS is the worst session window: shifts less than 1s apart, at most 5s long
+    let cls = 0;
+    let windowValue = 0;
+    let windowStart = 0;
+    let previous = -Infinity;
+    observed.layoutShifts.forEach((shift) => {
+        if (shift.startTime - previous > 1000 || shift.startTime - windowStart > 5000) {
+            windowValue = 0;
+            windowStart = shift.startTime;
+        }
+        windowValue += shift.value;
+        previous = shift.startTime;
+        cls = Math.max(cls, windowValue);
+    });
+
+    const fcp = paint["first-contentful-paint"];
+    let blockingTime = 0;
+    observed.longTasks.forEach((task) => {
+        if (fcp === undefined || task.startTime >= fcp) {
+            blockingTime += Math.max(0, task.duration - 50);
+        }
+    });
+
+    const resources = { count: 0, transferSize: 0, encodedBodySize: 0, byType: {} };
+    performance.getEntriesByType("resource").forEach((entry) => {
+        const byType = resources.byType[entry.initiatorType] ||= { count: 0, transferSize: 0 };
+        byType.count += 1;
+        byType.transferSize += entry.transferSize;
+        resources.count += 1;
+        resources.transferSize += entry.transferSize;
+        resources.encodedBodySize += entry.encodedBodySize;
+    });
+
+    return {
+        url: location.href,
+        navigation: navigation ? {
+            type: navigation.type,
+            redirectCount: navigation.redirectCount,
+            domainLookup: navigation.domainLookupEnd - navigation.domainLookupStart,
+            connect: navigation.connectEnd - navigation.connectStart,
+            requestStart: navigation.requestStart,
+            responseStart: navigation.responseStart,
+            responseEnd: navigation.responseEnd,
+            domInteractive: navigation.domInteractive,
+            domContentLoadedEventEnd: navigation.domContentLoadedEventEnd,
+            domComplete: navigation.domComplete,
+            loadEventEnd: navigation.loadEventEnd,
+            transferSize: navigation.transferSize,
+            encodedBodySize: navigation.encodedBodySize,
+            decodedBodySize: navigation.decodedBodySize,
+        } : null,
+        paint: {
+            firstPaint: paint["first-paint"] ?? null,
+            firstContentfulPaint: fcp ?? null,
+        },
+        largestContentfulPaint: observed.lcp,
+        cumulativeLayoutShift: cls,
+        longTasks: {
+            count: observed.longTasks.length,
+            totalDuration: observed.longTasks.reduce((sum, task) => sum + task.duration, 0),
+            totalBlockingTime: blockingTime,
+        },
+        resources,
+    };
+}
+"""
+
+
+async def install_metrics_observers(context):
+    await context.add_init_script(METRICS_INIT_SCRIPT)
+
+
+# Returns the run's metrics, or None when the page could not be evaluated
+async def collect_page_metrics(page):
+    try:
+        return await page.evaluate(COLLECT_METRICS_SCRIPT)
+    except Exception as e:
+        logger.info(f"Could not collect page metrics: {e}")
+        return None
+
+
+async def write_page_metrics(metrics, path):
+    data = json.dumps(metrics, indent=2).encode()
+    await asyncio.to_thread(write_artifact, path, data)
+
+
+async def read_page_metrics(path):
+    try:
+        return json.loads(await asyncio.to_thread(path.read_text))
+    except (OSError, ValueError):
+        return None
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.0f} ms"
+
+
+# Headline numbers shown on the results pages
+def summarize_metrics(metrics):
+    navigation = metrics.get("navigation") or {}
+    summary = {
+        "First Paint": format_ms(metrics["paint"]["firstPaint"]),
+        "First Contentful Paint": format_ms(metrics["paint"]["firstContentfulPaint"]),
+        "Largest Contentful Paint": format_ms(metrics["largestContentfulPaint"]),
+        "Cumulative Layout Shift": f"{metrics['cumulativeLayoutShift']:.3f}",
+        "Total Blocking Time": format_ms(metrics["longTasks"]["totalBlockingTime"]),
+        "DOM Content Loaded": format_ms(navigation.get("domContentLoadedEventEnd")),
+        "Load": format_ms(navigation.get("loadEventEnd")),
+        "Requests": str(metrics["resources"]["count"] + bool(navigation)),
+        "Transferred": f"{(metrics['resources']['transferSize'] + navigation.get('transferSize', 0)) / 1024:.0f} KB",
+    }
+    visual = metrics.get("visualProgress")
+    if visual:
+        summary["Speed Index"] = format_ms(visual["speedIndex"])
+        summary["First Visual Change"] = format_ms(visual["firstVisualChange"])
+        summary["Last Visual Change"] = format_ms(visual["lastVisualChange"])
+        summary["Visually Complete"] = format_ms(visual["visuallyComplete"])
+    return summary
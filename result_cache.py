@@ -0,0 +1,225 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import config
+from logger import logger
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Seconds before an entry directory missing from the index is removed
+ORPHAN_MIN_AGE = 3600
+
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+# Hard link a file, falling back to a copy across filesystems
+def link_or_copy(source, destination):
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+# Caches run artifacts by normalized URL, option, resolution and network
+# profile, with metrics-only and replayed runs kept apart from the others.
+# Each entry keeps hard links to the artifacts of the run that
+# produced it, so a hit links them into the new session without copying
+# and evicting an entry never breaks older result pages. Entries expire
+# after `ttl` seconds and the least recently used ones are evicted once
+# the cache holds more than `max_bytes`.
+class ResultCache:
+    def __init__(
+        self,
+        root=Path("static/results/cache"),
+        ttl=config.CACHE_TTL,
+        max_bytes=config.CACHE_MAX_BYTES,
+    ):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def key(
+        url,
+        option,
+        resolution,
+        network_profile,
+        metrics_only=False,
+        replay=False,
+        encoding_profile="default",
+    ):
+        parts = [normalize_url(url), option, resolution, network_profile or "none"]
+        if metrics_only:
+            parts.append("metrics")
+        # Keys of the default profile stay what they were before profiles
+        elif encoding_profile != "default":
+            parts.append(f"encoding:{encoding_profile}")
+        if replay:
+            parts.append("replay")
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    # Links the cached artifacts into output_dir, named after `prefix`, and
+    # returns their paths, or None on a miss
+    async def restore(self, key, output_dir, prefix):
+        entry = await self._update(self._touch, key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        entry_dir = self.root / key
+        try:
+            restored = await asyncio.to_thread(
+                self._link_files, entry_dir, entry["suffixes"], output_dir, prefix
+            )
+        except OSError as e:
+            logger.info(f"Dropping unreadable cache entry {key}: {e}")
+            await self._update(self._remove, key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return restored
+
+    # Artifacts are stored by the part of their name after `prefix`, so a
+    # hit can restore them under another run's prefix
+    async def store(self, key, paths, prefix):
+        paths = [Path(path) for path in paths if path]
+        if not paths:
+            return
+        suffixes = [path.name.removeprefix(prefix) for path in paths]
+        entry_dir = self.root / key
+        size = await asyncio.to_thread(
+            self._link_files_with_size, paths, suffixes, entry_dir
+        )
+        now = time.time()
+        entry = {
+            "suffixes": suffixes,
+            "bytes": size,
+            "created_at": now,
+            "last_used": now,
+        }
+        await self._update(self._add, key, entry)
+
+    def stats(self):
+        entries = self._entries or {}
+        return {
+            "entries": len(entries),
+            "bytes": sum(entry["bytes"] for entry in entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    # Runs mutate(entries, *args) on the index as it is on disk, writes it
+    # back and returns what mutate returned. The read-modify-write holds an
+    # flock on index.lock, so the processes sharing the cache (workers on
+    # one host) never overwrite each other's entries.
+    async def _update(self, mutate, *args):
+        async with self._lock:
+            return await asyncio.to_thread(self._locked_update, mutate, *args)
+
+    def _locked_update(self, mutate, *args):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / "index.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._read_index()
+            result = mutate(entries, *args)
+            self._write_index(entries)
+            self._entries = entries
+            return result
+
+    # The entry for key, marked as used, or None when missing or expired
+    def _touch(self, entries, key):
+        entry = entries.get(key)
+        if entry and time.time() - entry["created_at"] > self.ttl:
+            self._remove(entries, key)
+            entry = None
+        if entry is None:
+            return None
+        entry["last_used"] = time.time()
+        return dict(entry)
+
+    def _add(self, entries, key, entry):
+        entries[key] = entry
+        self._evict(entries)
+
+    def _evict(self, entries):
+        now = time.time()
+        for key, entry in list(entries.items()):
+            if now - entry["created_at"] > self.ttl:
+                self._remove(entries, key)
+        total = sum(entry["bytes"] for entry in entries.values())
+        by_last_use = sorted(entries.items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_last_use:
+            if total <= self.max_bytes:
+                break
+            total -= entry["bytes"]
+            self._remove(entries, key)
+        # Entry directories missing from the index (lost updates of older
+        # versions); ones just linked and about to be added are recent
+        for path in self.root.iterdir():
+            if (
+                path.is_dir()
+                and path.name not in entries
+                and now - path.stat().st_mtime > ORPHAN_MIN_AGE
+            ):
+                shutil.rmtree(path, True)
+
+    def _remove(self, entries, key):
+        entries.pop(key, None)
+        shutil.rmtree(self.root / key, True)
+
+    def _read_index(self):
+        try:
+            return json.loads((self.root / "index.json").read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, entries):
+        self.root.mkdir(parents=True, exist_ok=True)
+        index_path = self.root / "index.json"
+        temporary_path = index_path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(entries))
+        temporary_path.replace(index_path)
+
+    @staticmethod
+    def _link_files(source_dir, suffixes, output_dir, prefix):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        restored = []
+        for suffix in suffixes:
+            destination = output_dir / f"{prefix}{suffix}"
+            link_or_copy(source_dir / f"artifact{suffix}", destination)
+            restored.append(destination)
+        return restored
+
+    @staticmethod
+    def _link_files_with_size(paths, suffixes, entry_dir):
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        for path, suffix in zip(paths, suffixes):
+            link_or_copy(path, entry_dir / f"artifact{suffix}")
+        return sum(path.stat().st_size for path in paths)
+
+
+result_cache = ResultCache()
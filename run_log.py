@@ -0,0 +1,146 @@
+import asyncio
+import gzip
+import json
+import time
+
+from logger import logger
+
+# Events buffered before new ones are dropped (the writer fell behind)
+MAX_PENDING_EVENTS = 10000
+# Seconds between writes, so events are compressed in batches
+FLUSH_INTERVAL = 0.5
+
+
+# Streams a run's browser console messages, page errors, failed requests
+# and response timings to a gzip-compressed NDJSON file while the run is
+# in progress. Page event handlers only append a small dict to a queue;
+# JSON encoding, compression and file I/O happen in a worker thread, so
+# logging never stalls the capture loop. Each batch is flushed, so the
+# file can be read before the run ends.
+# Usage: async with RunLog(path) as run_log: run_log.attach(page)
+class RunLog:
+    def __init__(self, path):
+        self.path = path
+        self.events = 0
+        self.dropped = 0
+        # Set on close: False when the log could not be written
+        self.ok = False
+        self._queue = asyncio.Queue()
+        self._file = None
+        self._writer = None
+        self._closing = asyncio.Event()
+        self._statuses = {}
+        self._listeners = {
+            "console": self._on_console,
+            "pageerror": self._on_page_error,
+            "requestfailed": self._on_request_failed,
+            "response": self._on_response,
+            "requestfinished": self._on_request_finished,
+        }
+
+    async def __aenter__(self):
+        await asyncio.to_thread(self.path.parent.mkdir, parents=True, exist_ok=True)
+        self._file = await asyncio.to_thread(gzip.open, self.path, "wb")
+        self._writer = asyncio.create_task(self._write_loop())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def attach(self, page):
+        for event, listener in self._listeners.items():
+            page.on(event, listener)
+
+    def write(self, event):
+        if self._queue.qsize() >= MAX_PENDING_EVENTS:
+            self.dropped += 1
+            return
+        event["time"] = time.time()
+        self._queue.put_nowait(event)
+
+    # Writes what is still queued and closes the file
+    async def close(self):
+        self._queue.put_nowait(None)
+        self._closing.set()
+        self.ok = True
+        try:
+            await self._writer
+        except Exception as e:
+            logger.info(f"Could not write run log {self.path}: {e}")
+            self.ok = False
+        await asyncio.to_thread(self._file.close)
+        if self.dropped:
+            logger.info(f"Dropped {self.dropped} run log events for {self.path}")
+
+    async def _write_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            finished = batch[-1] is None
+            events = [event for event in batch if event is not None]
+            if events:
+                await asyncio.to_thread(self._append, events)
+                self.events += len(events)
+            if finished:
+                return
+            try:
+                await asyncio.wait_for(self._closing.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _append(self, events):
+        lines = "".join(json.dumps(event, default=str) + "\n" for event in events)
+        self._file.write(lines.encode())
+        self._file.flush()
+
+    def _on_console(self, message):
+        self.write(
+            {
+                "type": "console",
+                "level": message.type,
+                "text": message.text,
+                "location": message.location,
+            }
+        )
+
+    def _on_page_error(self, error):
+        self.write(
+            {
+                "type": "pageerror",
+                "name": error.name,
+                "message": error.message,
+                "stack": error.stack,
+            }
+        )
+
+    def _on_request_failed(self, request):
+        self._statuses.pop(request, None)
+        self.write(
+            {
+                "type": "requestfailed",
+                "url": request.url,
+                "method": request.method,
+                "resource_type": request.resource_type,
+                "failure": request.failure,
+            }
+        )
+
+    def _on_response(self, response):
+        self._statuses[response.request] = response.status
+
+    # Request.timing is complete once the request has finished; its times
+    # are milliseconds relative to startTime (-1 when not applicable)
+    def _on_request_finished(self, request):
+        timing = request.timing
+        self.write(
+            {
+                "type": "response",
+                "url": request.url,
+                "method": request.method,
+                "resource_type": request.resource_type,
+                "status": self._statuses.pop(request, None),
+                "duration_ms": timing["responseEnd"],
+                "timing": timing,
+            }
+        )
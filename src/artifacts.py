@@ -0,0 +1,140 @@
+import asyncio
+import gzip
+import mimetypes
+import os
+
+from quart import Response, request
+from quart.wrappers.response import FileBody
+from werkzeug.datastructures import ContentRange
+from werkzeug.sansio.http import is_resource_modified
+
+# Bytes read per thread hop when streaming a file
+CHUNK_SIZE = 256 * 1024
+# Finished artifacts never change, let clients keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Written next to the file as <name>.gz and sent to clients accepting gzip
+PRECOMPRESSED_SUFFIXES = {".html", ".json"}
+
+# requested_range() result for ranges outside the file (HTTP 416)
+UNSATISFIABLE = "unsatisfiable"
+
+mimetypes.add_type("application/x-ndjson", ".ndjson")
+
+
+# Writes data to path, plus a gzip copy for PRECOMPRESSED_SUFFIXES
+def write_artifact(path, data):
+    path.write_bytes(data)
+    if path.suffix in PRECOMPRESSED_SUFFIXES:
+        path.with_name(path.name + ".gz").write_bytes(gzip.compress(data, 9))
+
+
+# Streams a file (or a byte range of it) in CHUNK_SIZE preads, one worker
+# thread hop per chunk and no seek/tell round trips. Hypercorn has no
+# zero-copy sendfile, so this is the cheapest path it allows.
+class ArtifactBody(FileBody):
+    buffer_size = CHUNK_SIZE
+
+    async def __aenter__(self):
+        self._fd = await asyncio.to_thread(os.open, self.file_path, os.O_RDONLY)
+        self._position = self.begin
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await asyncio.to_thread(os.close, self._fd)
+
+    async def __anext__(self):
+        if self._position >= self.end:
+            raise StopAsyncIteration()
+        size = min(self.buffer_size, self.end - self._position)
+        chunk = await asyncio.to_thread(os.pread, self._fd, size, self._position)
+        if not chunk:
+            raise StopAsyncIteration()
+        self._position += len(chunk)
+        return chunk
+
+
+# Strong validator: an artifact is only ever replaced by a new file
+def artifact_etag(stat):
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+# Response for one session artifact with single range support (206/416),
+# If-None-Match / If-Modified-Since (304) and, when `immutable`, a year
+# long Cache-Control. HTML and JSON come from their precompressed copy
+# when the client accepts gzip. Returns None when the file is missing.
+async def send_artifact(path, immutable):
+    mimetype = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    encoding = None
+    compressible = path.suffix in PRECOMPRESSED_SUFFIXES
+    if compressible and "gzip" in request.headers.get("Accept-Encoding", ""):
+        compressed = path.with_name(path.name + ".gz")
+        if await asyncio.to_thread(compressed.is_file):
+            path, encoding = compressed, "gzip"
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except OSError:
+        return None
+
+    response = Response(ArtifactBody(path), mimetype=mimetype)
+    response.content_length = stat.st_size
+    response.last_modified = stat.st_mtime
+    etag = artifact_etag(stat)
+    if encoding:
+        response.content_encoding = encoding
+        etag += "-gz"
+    else:
+        response.accept_ranges = "bytes"
+    if compressible:
+        response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Still being written (e.g. a run log); revalidate every time
+        response.cache_control.no_cache = True
+    # 304 / 412 from the validators; ranges are resolved below, and only
+    # on the stored representation (a compressed response is sent whole)
+    await response.make_conditional(request)
+    if response.status_code == 200 and not encoding:
+        span = requested_range(response, stat.st_size)
+        if span == UNSATISFIABLE:
+            response = Response("", status=416)
+            response.content_range = ContentRange("bytes", None, None, stat.st_size)
+        elif span is not None:
+            begin, end = span
+            await response.response.make_conditional(begin, end)
+            response.status_code = 206
+            response.content_length = end - begin
+            response.content_range = ContentRange("bytes", begin, end, stat.st_size)
+    return response
+
+
+# The (begin, end) byte span of a single range request, end exclusive,
+# None to send the whole file (no Range, a stale If-Range, several
+# ranges or an unparsable header) or UNSATISFIABLE. Suffix ranges longer
+# than the file cover all of it.
+def requested_range(response, size):
+    if "Range" not in request.headers:
+        return None
+    if "If-Range" in request.headers and is_resource_modified(
+        http_range=request.headers.get("Range"),
+        http_if_range=request.headers.get("If-Range"),
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        ignore_if_range=False,
+    ):
+        return None
+    byte_range = request.range
+    if byte_range is None or byte_range.units != "bytes":
+        return None
+    if len(byte_range.ranges) != 1:
+        return None
+    begin, end = byte_range.ranges[0]
+    if begin < 0:
+        begin = max(0, size + begin)
+    end = size if end is None else min(end, size)
+    if begin >= end:
+        return UNSATISFIABLE
+    return begin, end
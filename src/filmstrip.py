@@ -0,0 +1,95 @@
+import asyncio
+from io import BytesIO
+import math
+
+from PIL import Image
+
+import config
+from logger import logger
+
+THUMBNAIL_WIDTH = 160
+# Thumbnails per row of the sprite
+SPRITE_COLUMNS = 10
+JPEG_QUALITY = 80
+
+
+def thumbnail(data, width=THUMBNAIL_WIDTH):
+    image = Image.open(BytesIO(data))
+    size = (width, max(1, round(image.height * width / image.width)))
+    # JPEG frames are decoded straight to about this size (DCT scaling)
+    image.draft("RGB", size)
+    return image.convert("RGB").resize(size)
+
+
+# Thumbnails left to right, top to bottom, SPRITE_COLUMNS per row
+def write_sprite(thumbnails, path):
+    width, height = thumbnails[0].size
+    columns = min(SPRITE_COLUMNS, len(thumbnails))
+    rows = math.ceil(len(thumbnails) / columns)
+    sprite = Image.new("RGB", (columns * width, rows * height), "white")
+    for index, image in enumerate(thumbnails):
+        row, column = divmod(index, columns)
+        sprite.paste(image.resize((width, height)), (column * width, row * height))
+    sprite.save(path, "JPEG", quality=JPEG_QUALITY)
+
+
+def write_poster(data, path):
+    image = Image.open(BytesIO(data))
+    if image.format == "JPEG":
+        path.write_bytes(data)  # Screencast frames are JPEG already
+    else:
+        image.convert("RGB").save(path, "JPEG", quality=JPEG_QUALITY)
+
+
+# Fed every distinct frame of a run by its encoder, like the visual
+# progress recorder. The filmstrip samples what the page showed every
+# `interval` seconds from the first frame on: a frame is only thumbnailed
+# (in a worker thread, while capture runs) once the next frame shows it
+# covered a sample point. The last frame becomes the poster.
+class FilmstripRecorder:
+    def __init__(self, interval=config.FILMSTRIP_INTERVAL_MS / 1000):
+        self.interval = interval
+        # One thumbnail future per sample point, repeated while a frame lasts
+        self.samples = []
+        self._origin = None
+        self._next_sample = 0
+        self._held = None
+
+    def add(self, data, timestamp):
+        if self._origin is None:
+            self._origin = timestamp
+        self._sample_until(timestamp)
+        self._held = data
+
+    # The held frame was on screen at every sample point before `until`
+    def _sample_until(self, until):
+        count = 0
+        while self._origin + self._next_sample * self.interval < until:
+            self._next_sample += 1
+            count += 1
+        if count and self._held is not None:
+            future = asyncio.get_running_loop().run_in_executor(
+                None, thumbnail, self._held
+            )
+            self.samples.extend([future] * count)
+
+    # Writes the poster and the filmstrip sprite for a capture that ended at
+    # end_time. Returns their paths, None for the ones not written.
+    async def write(self, poster_path, filmstrip_path, end_time):
+        if self._held is None:
+            return None, None
+        self._sample_until(end_time)
+        try:
+            await asyncio.to_thread(write_poster, self._held, poster_path)
+        except Exception as e:
+            logger.info(f"Could not write poster {poster_path}: {e}")
+            poster_path = None
+        try:
+            thumbnails = await asyncio.gather(*self.samples)
+            if not thumbnails:
+                thumbnails = [await asyncio.to_thread(thumbnail, self._held)]
+            await asyncio.to_thread(write_sprite, thumbnails, filmstrip_path)
+        except Exception as e:
+            logger.info(f"Could not write filmstrip {filmstrip_path}: {e}")
+            filmstrip_path = None
+        return poster_path, filmstrip_path
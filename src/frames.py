@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import tempfile
+
+import config
+from logger import logger
+
+
+# Drops frames that are byte-identical to the previous one. An unchanged
+# page screenshots to the same bytes, so a digest is all that is needed.
+class FrameDeduplicator:
+    def __init__(self):
+        self.frames = 0
+        self.duplicates = 0
+        self._last_digest = None
+
+    def is_duplicate(self, data):
+        self.frames += 1
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == self._last_digest:
+            self.duplicates += 1
+            return True
+        self._last_digest = digest
+        return False
+
+
+# Holds a run's distinct frames (data, timestamp) until they can be
+# encoded, without writing them to persistent disk. At most max_bytes of
+# frame data stays in memory: beyond that the oldest in-memory frames move
+# to files in spill_dir (meant to be a tmpfs such as /dev/shm), or without
+# one every other buffered frame is dropped. A dropped frame only makes
+# the one before it last longer, so the video still covers the whole run,
+# at a lower frame rate.
+class FrameBuffer:
+    def __init__(
+        self, max_bytes=config.FRAME_BUFFER_MAX_BYTES, spill_dir=config.FRAME_SPILL_DIR
+    ):
+        self.max_bytes = max_bytes
+        self.spill_root = spill_dir
+        # [data or spill file path, timestamp], oldest first; spilled
+        # frames always come before the ones still in memory
+        self._frames = []
+        self._spilled = 0
+        self._spill_dir = None
+        self.memory_bytes = 0
+        self.peak_bytes = 0
+        self.spilled_bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    async def add(self, data, timestamp):
+        self._frames.append([data, timestamp])
+        self.memory_bytes += len(data)
+        self.peak_bytes = max(self.peak_bytes, self.memory_bytes)
+        while self.memory_bytes > self.max_bytes and self._spilled < len(self._frames):
+            if self.spill_root and await self._spill_oldest():
+                continue
+            if not self._thin_out():
+                break
+
+    # Yields every buffered frame in order; spilled ones are read back
+    async def frames(self):
+        for data, timestamp in self._frames:
+            if isinstance(data, Path):
+                data = await asyncio.to_thread(data.read_bytes)
+            yield data, timestamp
+
+    # Frees the buffered frames and removes the spill files
+    async def clear(self):
+        self._frames = []
+        self._spilled = 0
+        self.memory_bytes = 0
+        if self._spill_dir is not None:
+            await asyncio.to_thread(shutil.rmtree, self._spill_dir, True)
+            self._spill_dir = None
+
+    def stats(self):
+        return {
+            "buffer_peak_bytes": self.peak_bytes,
+            "spilled_bytes": self.spilled_bytes,
+            "dropped_frames": self.dropped,
+        }
+
+    # Returns False (and stops spilling) when the spill directory fails
+    async def _spill_oldest(self):
+        frame = self._frames[self._spilled]
+        data = frame[0]
+        try:
+            if self._spill_dir is None:
+                await asyncio.to_thread(os.makedirs, self.spill_root, exist_ok=True)
+                self._spill_dir = Path(
+                    await asyncio.to_thread(tempfile.mkdtemp, dir=self.spill_root)
+                )
+            path = self._spill_dir / f"{self._spilled:05d}"
+            await asyncio.to_thread(path.write_bytes, data)
+        except OSError as e:
+            logger.info(f"Could not spill frames to {self.spill_root}: {e}")
+            self.spill_root = None
+            return False
+        frame[0] = path
+        self._spilled += 1
+        self.memory_bytes -= len(data)
+        self.spilled_bytes += len(data)
+        return True
+
+    # Drops every other in-memory frame, keeping the first and the last.
+    # Returns False when there is nothing left to drop.
+    def _thin_out(self):
+        in_memory = self._frames[self._spilled :]
+        if len(in_memory) < 3:
+            return False
+        kept = in_memory[::2]
+        if kept[-1] is not in_memory[-1]:
+            kept.append(in_memory[-1])
+        self.dropped += len(in_memory) - len(kept)
+        self.memory_bytes = sum(len(data) for data, _ in kept)
+        self._frames[self._spilled :] = kept
+        return True
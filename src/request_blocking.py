@@ -0,0 +1,122 @@
+import asyncio
+
+from browser_pool import browser_pool
+import config
+from telemetry import ROUTE_CALLBACKS
+
+DISPATCH_CALLBACKS = ROUTE_CALLBACKS.labels("dispatch")
+FETCH_CALLBACKS = ROUTE_CALLBACKS.labels("fetch_blocked")
+
+# Playwright resource types and their CDP Network.ResourceType names
+CDP_RESOURCE_TYPES = {
+    "document": "Document",
+    "stylesheet": "Stylesheet",
+    "image": "Image",
+    "media": "Media",
+    "font": "Font",
+    "script": "Script",
+    "xhr": "XHR",
+    "fetch": "Fetch",
+}
+
+
+# Resource types and URL suffixes a run blocks
+def blocked_requests(disable_images, disable_css):
+    resource_types = set()
+    url_suffixes = []
+    if disable_images:
+        resource_types.add("image")
+    if disable_css:
+        resource_types.add("stylesheet")
+        url_suffixes.append(".css")
+    return resource_types, url_suffixes
+
+
+# "cdp" blocks inside Chromium, "route" uses a Playwright route
+def blocking_mode():
+    if config.REQUEST_BLOCKING == "auto":
+        return "cdp" if browser_pool.browser_type == "chromium" else "route"
+    return config.REQUEST_BLOCKING
+
+
+# Blocks requests inside Chromium. URL suffixes go to
+# Network.setBlockedURLs and never leave the browser; resource types are
+# matched by Fetch interception patterns, so only the requests being
+# blocked are paused and sent here to be failed.
+async def block_in_browser(context, page, resource_types, url_suffixes):
+    cdp_session = await context.new_cdp_session(page)
+    if url_suffixes:
+        await cdp_session.send("Network.enable")
+        await cdp_session.send(
+            "Network.setBlockedURLs",
+            {"urls": [f"*{suffix}" for suffix in url_suffixes]},
+        )
+    if resource_types:
+
+        async def fail_request(params):
+            FETCH_CALLBACKS.inc()
+            try:
+                await cdp_session.send(
+                    "Fetch.failRequest",
+                    {
+                        "requestId": params["requestId"],
+                        "errorReason": "BlockedByClient",
+                    },
+                )
+            except Exception:
+                pass  # Page closed while the request was paused
+
+        cdp_session.on("Fetch.requestPaused", fail_request)
+        await cdp_session.send(
+            "Fetch.enable",
+            {
+                "patterns": [
+                    {
+                        "urlPattern": "*",
+                        "resourceType": CDP_RESOURCE_TYPES[resource_type],
+                        "requestStage": "Request",
+                    }
+                    for resource_type in sorted(resource_types)
+                ]
+            },
+        )
+
+
+# One route handler for everything a run does per request: abort blocked
+# requests, otherwise wait delay_ms and fall back to the next route (or
+# the network)
+def make_request_dispatcher(resource_types=(), url_suffixes=(), delay_ms=0):
+    resource_types = frozenset(resource_types)
+    url_suffixes = tuple(url_suffixes)
+    delay = delay_ms / 1000
+
+    async def dispatch_request(route):
+        DISPATCH_CALLBACKS.inc()
+        request = route.request
+        if request.resource_type in resource_types or (
+            url_suffixes and request.url.endswith(url_suffixes)
+        ):
+            await route.abort()
+            return
+        if delay:
+            await asyncio.sleep(delay)
+        await route.fallback()
+
+    return dispatch_request
+
+
+# Sets up blocking and the slow route delay for a run. Python only sees
+# every request when it has to delay them or the browser cannot block
+# them by itself.
+async def install_request_rules(
+    context, page, resource_types, url_suffixes, delay_ms=0, mode=None
+):
+    mode = mode or blocking_mode()
+    if mode == "cdp":
+        if resource_types or url_suffixes:
+            await block_in_browser(context, page, resource_types, url_suffixes)
+        resource_types, url_suffixes = (), ()
+    if resource_types or url_suffixes or delay_ms:
+        await context.route(
+            "**/*", make_request_dispatcher(resource_types, url_suffixes, delay_ms)
+        )
@@ -0,0 +1,125 @@
+import asyncio
+from pathlib import Path
+import shutil
+import time
+
+import config
+from logger import logger
+
+
+# Size of a directory tree. Files also hard linked elsewhere (the result
+# cache) are only counted towards `bytes`, not `reclaimable`.
+def directory_usage(path):
+    total = reclaimable = 0
+    for file in Path(path).rglob("*"):
+        try:
+            stat = file.stat()
+        except OSError:
+            continue
+        if file.is_file():
+            total += stat.st_size
+            if stat.st_nlink == 1:
+                reclaimable += stat.st_size
+    return total, reclaimable
+
+
+def remove_tree(path):
+    _, reclaimable = directory_usage(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return reclaimable
+
+
+# Deletes session directories under static/results that are older than
+# max_age seconds, then the oldest remaining ones while the total is above
+# max_bytes. Sessions with a job still running are skipped. Every directory
+# is measured and removed in a worker thread, one at a time, so a large
+# cleanup never blocks the event loop.
+class ResultsCollector:
+    def __init__(
+        self,
+        root=Path("static/results"),
+        max_age=config.RESULTS_MAX_AGE,
+        max_bytes=config.RESULTS_MAX_BYTES,
+        interval=config.RESULTS_GC_INTERVAL,
+        is_active=lambda session_id: False,
+        skip=("cache",),
+    ):
+        self.root = Path(root)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.is_active = is_active
+        self.skip = set(skip)
+        self.bytes_reclaimed = 0
+        self.sessions_removed = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def collect(self):
+        sessions = await asyncio.to_thread(self._list_sessions)
+        reclaimed = removed = 0
+        now = time.time()
+        kept = []
+        for path, modified in sessions:
+            if self.is_active(path.name):
+                continue
+            if self.max_age and now - modified > self.max_age:
+                reclaimed += await asyncio.to_thread(remove_tree, path)
+                removed += 1
+            else:
+                kept.append(path)
+
+        if self.max_bytes:
+            usage = []
+            for path in kept:
+                size, _ = await asyncio.to_thread(directory_usage, path)
+                usage.append((path, size))
+            total = sum(size for _, size in usage)
+            # kept is ordered oldest first
+            for path, size in usage:
+                if total <= self.max_bytes:
+                    break
+                reclaimed += await asyncio.to_thread(remove_tree, path)
+                removed += 1
+                total -= size
+
+        self.bytes_reclaimed += reclaimed
+        self.sessions_removed += removed
+        if removed:
+            logger.info(
+                f"Removed {removed} result sessions, reclaimed {reclaimed} bytes"
+            )
+        return reclaimed
+
+    def stats(self):
+        return {
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "sessions_removed": self.sessions_removed,
+        }
+
+    def _list_sessions(self):
+        if not self.root.exists():
+            return []
+        sessions = [
+            (path, path.stat().st_mtime)
+            for path in self.root.iterdir()
+            if path.is_dir() and path.name not in self.skip
+        ]
+        return sorted(sessions, key=lambda session: session[1])
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as e:
+                logger.info(f"Results collection failed: {e}")
+            await asyncio.sleep(self.interval)
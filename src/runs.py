@@ -0,0 +1,112 @@
+import asyncio
+from pathlib import Path
+
+import config
+from logger import logger
+from page_metrics import read_page_metrics, summarize_metrics
+from result_cache import result_cache
+from telemetry import StageTimer
+from web_pw_run import load_page_with_screenshots, record_har
+
+SLOW_NETWORK_PROFILE = "Fast 3G"
+
+
+# Performs one run of a job (see jobs.run_spec), in the web process or in
+# a worker. The stage timings and frame memory end up in the run's result.
+async def run_option(job, spec, timer=None):
+    timer = timer or StageTimer()
+    memory = {}
+    try:
+        await perform_run(job, spec, timer, memory)
+    finally:
+        job.results[spec["run_id"]]["timings"] = timer.summary()
+        job.results[spec["run_id"]]["memory"] = memory or None
+
+
+async def perform_run(job, spec, timer, memory=None):
+    option = spec["option"]
+    network_profile = spec["network_profile"]
+    if option == "slowNetwork" and network_profile is None:
+        network_profile = SLOW_NETWORK_PROFILE
+    # Create distinct flags for each option/task
+    disable_js = "disableJavascript" == option
+    disable_images = "disableImages" == option
+    disable_css = "disableCSS" == option
+    slow_route = "highLatency" == option
+    slow_network_chrome = network_profile is not None
+
+    logger.info(
+        f"Creating task for run: {spec['run_id']} - Flags: disable_js: {disable_js}, disable_images: {disable_images}, disable_css: {disable_css}, slow_route: {slow_route}, network_profile: {network_profile}"
+    )
+
+    output_dir = Path(f"static/results/{job.job_id}")
+    cache_key = result_cache.key(
+        job.url,
+        option,
+        spec["resolution"],
+        network_profile,
+        job.metrics_only,
+        job.replay,
+        job.encoding_profile,
+    )
+    if result_cache.enabled and not job.force_refresh:
+        with timer.stage("cache"):
+            restored = await result_cache.restore(cache_key, output_dir, spec["run_id"])
+        if restored:
+            logger.info(f"Reusing cached results for run: {spec['run_id']}")
+            job.cached.add(spec["run_id"])
+            await attach_metrics(job, spec["run_id"], output_dir)
+            return
+
+    har_path = None
+    if job.replay:
+        with timer.stage("har_recording"):
+            har_path = await job_har(job)
+    artifacts = await load_page_with_screenshots(
+        session_id=job.job_id,
+        test_type=spec["run_id"],
+        url=job.url,
+        screenshot_interval=0.05,
+        load_duration=10,
+        disable_js=disable_js,
+        disable_images=disable_images,
+        disable_css=disable_css,
+        slow_route=slow_route,
+        slow_network_chrome=slow_network_chrome,
+        screen_resolution=spec["resolution"],
+        network_profile=network_profile,
+        metrics_only=job.metrics_only,
+        har_path=har_path,
+        encoding_profile=job.encoding_profile,
+        timer=timer,
+        memory=memory,
+    )
+    if job.metrics_only and not artifacts["metrics"]:
+        raise RuntimeError("No page metrics were collected")
+    if not job.metrics_only and not artifacts["video"]:
+        raise RuntimeError("No video was created")
+    if result_cache.enabled:
+        with timer.stage("cache"):
+            await result_cache.store(cache_key, artifacts.values(), spec["run_id"])
+    await attach_metrics(job, spec["run_id"], output_dir)
+
+
+# The HAR replayed by the job's runs. The first run to ask in this process
+# records it (or finds the one another worker recorded, see record_har)
+# and the others wait for that recording.
+async def job_har(job):
+    if config.HAR_FIXTURE:
+        return Path(config.HAR_FIXTURE)
+    if job.har_recording is None:
+        job.har_recording = asyncio.ensure_future(
+            record_har(job.job_id, job.url, load_duration=10)
+        )
+    # A cancelled run must not cancel the recording the other runs wait for
+    return await asyncio.shield(job.har_recording)
+
+
+# Adds the headline page metrics of a finished run to its result
+async def attach_metrics(job, run_id, output_dir):
+    metrics = await read_page_metrics(output_dir / f"{run_id}.json")
+    if metrics is not None:
+        job.results[run_id]["metrics"] = summarize_metrics(metrics)
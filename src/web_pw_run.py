@@ -1,26 +1,58 @@
 import asyncio
+import base64
+import contextlib
+import functools
+import json
+import os
 from pathlib import Path
-import subprocess
 import time
-from playwright.async_api import async_playwright
+import uuid
 
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from browser_pool import browser_pool
+from capture_schedule import CaptureSchedule
+import config
+from filmstrip import FilmstripRecorder
 from logger import logger
+from network_shaping import shaping_mode, shaping_proxy
+from page_metrics import (
+    collect_page_metrics,
+    install_metrics_observers,
+    write_page_metrics,
+)
+from request_blocking import blocked_requests, install_request_rules
+from run_log import RunLog
+from telemetry import FRAMES_CAPTURED, ROUTE_CALLBACKS, StageTimer
+from video_encoder import encode_stage, video_filename
+from visual_progress import VisualProgressRecorder
+
+POLLED_FRAMES = FRAMES_CAPTURED.labels("poll")
+SCREENCAST_FRAMES = FRAMES_CAPTURED.labels("screencast")
+REPLAY_CALLBACKS = ROUTE_CALLBACKS.labels("replay_throttle")
 
 network_conditions = {
     "Slow 3G": {
         "downloadThroughput": int((500 * 1000) / 8 * 0.8),
         "uploadThroughput": int((500 * 1000) / 8 * 0.8),
         "latency": int(400 * 5),
+        # Only applied by the shaping proxy
+        "jitter": 200,
+        "packetLoss": 0.02,
     },
     "Fast 3G": {
         "downloadThroughput": int((1.6 * 1000 * 1000) / 8 * 0.9),
         "uploadThroughput": int((750 * 1000) / 8 * 0.9),
         "latency": int(150 * 3.75),
+        "jitter": 60,
+        "packetLoss": 0.01,
     },
     "LTE": {
         "downloadThroughput": int((50 * 1000 * 1000) / 8 * 0.9),  # 90% of 50 Mbps
         "uploadThroughput": int((25 * 1000 * 1000) / 8 * 0.9),  # 90% of 25 Mbps
         "latency": 50,  # Average latency
+        "jitter": 10,
+        "packetLoss": 0.005,
     },
     "5G": {
         "downloadThroughput": int((1 * 1000 * 1000 * 1000) / 8 * 0.8),  # 80% of 1 Gbps
@@ -35,47 +67,78 @@ network_conditions = {
 }
 
 
-async def capture_screenshots(page, interval, duration, screenshot_dir, file_prefix):
-    start_time = time.time()
-    count = 0
-    while time.time() - start_time < duration:
-        screenshot_path = screenshot_dir / f"{file_prefix}_{count}.png"
-        await page.screenshot(path=str(screenshot_path))
-        count += 1
-        # logger.info(f"Captured screenshot {count} for {page} - {file_prefix}")
-        await asyncio.sleep(interval)
-
-
-async def create_video(screenshot_dir, file_prefix, output_filename):
-    pattern = str(screenshot_dir / f"{file_prefix}_*.png")
-    screenshot_files = list(screenshot_dir.glob(f"{file_prefix}_*.png"))
-    frame_count = len(screenshot_files)
-    if frame_count == 0:
-        logger.info("No screenshots found, video will not be created.")
-        return
-    frame_rate = max(1, frame_count / 20)  # Ensure frame rate is at least 1
-
-    logger.info(f"Creating video at {frame_rate} frames per second.")
-    ffmpeg_command = [
-        "ffmpeg",
-        "-framerate",
-        str(frame_rate),
-        "-pattern_type",
-        "glob",
-        "-i",
-        pattern,
-        "-c:v",
-        "libx264",
-        "-pix_fmt",
-        "yuv420p",
-        str(output_filename),
-    ]
-    subprocess.run(ffmpeg_command)
-    logger.info(f"Video created at: {output_filename} with framerate {frame_rate}")
+# Poll page.screenshot(), timed by the CaptureSchedule: dense while the
+# page is loading or changing, sparse once it is quiet. JPEG frames are
+# far cheaper for the browser to encode and for ffmpeg to decode than PNG.
+async def capture_screenshots(
+    page, schedule, duration, encoder, frame_format="jpeg", quality=None
+):
+    options = {"type": frame_format}
+    if frame_format == "jpeg" and quality is not None:
+        options["quality"] = quality
+    deadline = time.time() + duration
+    try:
+        while time.time() < deadline:
+            schedule.begin_frame()
+            frame = await page.screenshot(**options)
+            POLLED_FRAMES.inc()
+            await encoder.write(frame, time.time())
+            await schedule.wait(frame, deadline)
+    finally:
+        schedule.uninstall()
+
+
+# Capture frames pushed by Chromium through CDP Page.startScreencast.
+# Chromium sends a compressed frame whenever the page repaints, so there
+# is no per-frame screenshot round-trip and idle pages cost nothing.
+async def capture_screencast(page, duration, encoder, quality):
+    cdp_session = await page.context.new_cdp_session(page)
+
+    async def handle_frame(params):
+        SCREENCAST_FRAMES.inc()
+        await encoder.write(
+            base64.b64decode(params["data"]), params["metadata"]["timestamp"]
+        )
+        # Chromium stops sending frames until the previous one is acked
+        try:
+            await cdp_session.send(
+                "Page.screencastFrameAck", {"sessionId": params["sessionId"]}
+            )
+        except Exception:
+            pass  # Session closed while the frame was in flight
+
+    cdp_session.on("Page.screencastFrame", handle_frame)
+    viewport = page.viewport_size
+    await cdp_session.send(
+        "Page.startScreencast",
+        {
+            "format": "jpeg",
+            "quality": quality,
+            "maxWidth": viewport["width"],
+            "maxHeight": viewport["height"],
+            "everyNthFrame": 1,
+        },
+    )
+    await asyncio.sleep(duration)
+    await cdp_session.send("Page.stopScreencast")
+    await cdp_session.detach()
+
+
+def use_screencast():
+    if config.CAPTURE_MODE == "auto":
+        return browser_pool.browser_type == "chromium"
+    return config.CAPTURE_MODE == "screencast"
 
 
 # Load a web page using Playwright and capture screenshots
-# Returns a tuple of (video_filename, log_filename)
+# With metrics_only, nothing is captured and the run ends as soon as the
+# network is idle (or after load_duration), only page metrics are saved
+# With har_path, every response is replayed from that HAR file and
+# requests missing from it are aborted
+# Stages (context, navigation, capture or load, page_metrics, encode) are
+# timed with `timer`, and the memory taken by the run's frames (see
+# memory_stats in video_encoder.py) is added to `memory` when given
+# Returns a dict of the artifacts created for the run
 async def load_page_with_screenshots(
     session_id,
     test_type,
@@ -89,7 +152,14 @@ async def load_page_with_screenshots(
     slow_network_chrome,
     screen_resolution,
     delay_ms=2000,
+    network_profile="Fast 3G",
+    metrics_only=False,
+    har_path=None,
+    encoding_profile=config.ENCODING_PROFILE,
+    timer=None,
+    memory=None,
 ):
+    timer = timer or StageTimer()
     logger.info(
         f"Starting test: {test_type}, disable_js: {disable_js}, disable_images: {disable_images}, disable_css: {disable_css}, slow_route: {slow_route}, slow_network_chrome: {slow_network_chrome}, resolution: {screen_resolution}"
     )
@@ -99,72 +169,220 @@ async def load_page_with_screenshots(
     file_prefix = test_type
     width, height = map(int, screen_resolution.split("x"))
     logger.info(f"Test type: {test_type}")
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
-        context = await browser.new_context(
+    # Chromium emulates the profile itself; other engines (or
+    # NETWORK_SHAPING=proxy) send the context through a shaping proxy lane.
+    # Replayed responses never touch the network and are throttled below.
+    proxy_shaping = slow_network_chrome and not har_path and shaping_mode() == "proxy"
+    shaped_conditions = network_conditions[network_profile] if proxy_shaping else None
+    context_started = time.perf_counter()
+    # Console messages, page errors, failed requests and response timings
+    async with (
+        RunLog(screenshot_dir / f"{file_prefix}.log.ndjson.gz") as run_log,
+        shaping_proxy.lane(shaped_conditions) as lane,
+        browser_pool.new_context(
             java_script_enabled=not disable_js,
             viewport={"width": width, "height": height},
-        )
-
-        if disable_images:
-            await context.route(
-                "**/*",
-                lambda route: route.abort()
-                if route.request.resource_type == "image"
-                else route.continue_(),
-            )
-        if disable_css:
-            await context.route(
-                "**/*",
-                lambda route: route.abort()
-                if route.request.resource_type == "stylesheet"
-                or route.request.url.endswith(".css")
-                else route.continue_(),
-            )
+            proxy=lane.proxy if lane else None,
+        ) as context,
+    ):
+        timer.record("context", time.perf_counter() - context_started)
+        if har_path:
+            # Registered first so every route below falls back to it
+            await context.route_from_har(har_path)
+            if slow_network_chrome:
+                sizes = await asyncio.to_thread(har_response_sizes, str(har_path))
+                await context.route(
+                    "**/*",
+                    make_handle_replay_throttle(
+                        network_conditions[network_profile], sizes
+                    ),
+                )
 
+        await install_metrics_observers(context)
         page = await context.new_page()
+        run_log.attach(page)
 
-        if slow_route:
-            await context.route("**", make_handle_slow_route(delay_ms))
+        # Blocking happens inside Chromium where possible; the Python route
+        # falls back to the next one (the recorded HAR when replaying)
+        await install_request_rules(
+            context,
+            page,
+            *blocked_requests(disable_images, disable_css),
+            delay_ms=delay_ms if slow_route else 0,
+        )
 
-        if slow_network_chrome:
-            # TODO: allow passing of variantion of network conditions
+        if slow_network_chrome and not har_path and not proxy_shaping:
+            conditions = network_conditions[network_profile]
             cdp_session = await context.new_cdp_session(page)
             await cdp_session.send("Network.enable")
             await cdp_session.send(
                 "Network.emulateNetworkConditions",
                 {
                     "offline": False,
-                    "latency": network_conditions["Fast 3G"]["latency"],
-                    "downloadThroughput": network_conditions["Fast 3G"][
-                        "downloadThroughput"
-                    ],
-                    "uploadThroughput": network_conditions["Fast 3G"][
-                        "uploadThroughput"
-                    ],
+                    "latency": conditions["latency"],
+                    "downloadThroughput": conditions["downloadThroughput"],
+                    "uploadThroughput": conditions["uploadThroughput"],
                 },
             )
 
-        screenshot_task = asyncio.create_task(
-            capture_screenshots(
-                page, screenshot_interval, load_duration, screenshot_dir, file_prefix
+        recorder = filmstrip = None
+        if metrics_only:
+            encoder = None
+            with timer.stage("navigation"):
+                await page.goto(url)
+            try:
+                with timer.stage("load"):
+                    await page.wait_for_load_state(
+                        "networkidle", timeout=load_duration * 1000
+                    )
+            except PlaywrightTimeoutError:
+                logger.info(f"Network not idle after {load_duration}s: {test_type}")
+        else:
+            # Screencast is Chromium-only, other engines fall back to polling
+            screencast = use_screencast()
+            # Distinct frames also feed the visual progress analysis and the
+            # poster and filmstrip, so all of them come out of one pass
+            recorder = VisualProgressRecorder()
+            filmstrip = FilmstripRecorder()
+            # Frames are piped straight into ffmpeg as they are captured, or
+            # held in memory for the encode queue when every encode slot is
+            # busy; they never touch persistent disk
+            frame_format = "jpeg" if screencast else config.SCREENSHOT_FORMAT
+            encoder = await encode_stage.open(
+                screenshot_dir / video_filename(file_prefix, encoding_profile),
+                frame_format,
+                (recorder, filmstrip),
+                encoding_profile,
             )
-        )
-        await page.goto(url)
-        await screenshot_task
+            screenshot_task = None
+            try:
+                if screencast:
+                    screenshot_task = asyncio.create_task(
+                        capture_screencast(
+                            page, load_duration, encoder, config.SCREENCAST_QUALITY
+                        )
+                    )
+                else:
+                    schedule = CaptureSchedule(page, screenshot_interval)
+                    await schedule.install()
+                    screenshot_task = asyncio.create_task(
+                        capture_screenshots(
+                            page,
+                            schedule,
+                            load_duration,
+                            encoder,
+                            frame_format,
+                            config.SCREENSHOT_QUALITY,
+                        )
+                    )
+                capture_started = time.perf_counter()
+                navigation_start = time.time()
+                with timer.stage("navigation"):
+                    await page.goto(url)
+                await screenshot_task
+                timer.record("capture", time.perf_counter() - capture_started)
+            except BaseException:
+                # Stop capturing into the encoder before it goes away
+                if screenshot_task is not None:
+                    screenshot_task.cancel()
+                    with contextlib.suppress(asyncio.CancelledError, Exception):
+                        await screenshot_task
+                await encoder.abort()
+                raise
 
+        with timer.stage("page_metrics"):
+            metrics = await collect_page_metrics(page)
         await page.close()
-        await context.close()
-        await browser.close()
 
-    await create_video(
-        screenshot_dir, file_prefix, screenshot_dir / f"{file_prefix}.mp4"
-    )
+    video_path = screenshot_dir / video_filename(file_prefix, encoding_profile)
+    video_created = False
+    poster_path = filmstrip_path = None
+    if encoder is not None:
+        end_time = time.time()
+        with timer.stage("encode"):
+            video_created, (poster_path, filmstrip_path) = await asyncio.gather(
+                encoder.close(end_time),
+                filmstrip.write(
+                    screenshot_dir / f"{file_prefix}.poster.jpg",
+                    screenshot_dir / f"{file_prefix}.filmstrip.jpg",
+                    end_time,
+                ),
+            )
+        if memory is not None:
+            memory.update(encoder.memory_stats())
+
+    metrics_path = screenshot_dir / f"{file_prefix}.json"
+    if metrics is not None:
+        with timer.stage("page_metrics"):
+            if recorder:
+                metrics["visualProgress"] = await recorder.analyze(navigation_start)
+            await write_page_metrics(metrics, metrics_path)
+    return {
+        "video": video_path if video_created else None,
+        "poster": poster_path if video_created else None,
+        "filmstrip": filmstrip_path if video_created else None,
+        "metrics": metrics_path if metrics is not None else None,
+        "log": run_log.path if run_log.ok else None,
+    }
+
+
+# Loads the page once without any test option and records every response
+# into a HAR file for the other runs of the session to replay. Workers
+# sharing the results directory reuse a HAR another worker has recorded;
+# workers recording at the same time each write a file of their own and
+# move it into place whole, so a run never replays a half written HAR.
+async def record_har(session_id, url, load_duration):
+    har_path = Path(f"static/results/{session_id}/recording.har")
+    if har_path.exists():
+        logger.info(f"Replaying HAR recorded at {har_path}")
+        return har_path
+    har_path.parent.mkdir(parents=True, exist_ok=True)
+    recording_path = har_path.with_name(f"recording.{uuid.uuid4().hex}.har")
+    try:
+        async with browser_pool.new_context(record_har_path=recording_path) as context:
+            page = await context.new_page()
+            await page.goto(url)
+            try:
+                await page.wait_for_load_state(
+                    "networkidle", timeout=load_duration * 1000
+                )
+            except PlaywrightTimeoutError:
+                logger.info(
+                    f"Network not idle after {load_duration}s, saving HAR anyway"
+                )
+        # The HAR is written when the context closes
+        if not recording_path.exists():
+            raise RuntimeError("No HAR was recorded")
+        os.replace(recording_path, har_path)
+    finally:
+        recording_path.unlink(missing_ok=True)
+    logger.info(f"Recorded HAR at {har_path}")
+    return har_path
+
+
+# Transfer size of every recorded response, by URL
+@functools.lru_cache(maxsize=8)
+def har_response_sizes(har_path):
+    sizes = {}
+    for entry in json.loads(Path(har_path).read_text())["log"]["entries"]:
+        response = entry["response"]
+        size = response.get("bodySize", -1)
+        if size < 0:
+            size = response.get("content", {}).get("size", 0)
+        sizes[entry["request"]["url"]] = max(0, size) + max(
+            0, response.get("headersSize", 0)
+        )
+    return sizes
 
 
-def make_handle_slow_route(delay_ms):
-    async def handle_slow_route(route):
-        await asyncio.sleep(delay_ms / 1000)
-        await route.continue_()
+# Delays each replayed response by the profile's latency plus the time its
+# recorded size takes at the profile's download throughput
+def make_handle_replay_throttle(conditions, sizes):
+    async def handle_replay_throttle(route):
+        REPLAY_CALLBACKS.inc()
+        size = sizes.get(route.request.url, 0)
+        transfer_seconds = size / conditions["downloadThroughput"]
+        await asyncio.sleep(conditions["latency"] / 1000 + transfer_seconds)
+        await route.fallback()
 
-    return handle_slow_route
+    return handle_replay_throttle
@@ -0,0 +1,257 @@
+import asyncio
+import bisect
+from contextlib import contextmanager
+import time
+
+from logger import logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Minimal Prometheus metrics: updating one is a dict lookup and an
+# addition, so they are cheap enough for per-frame and per-request paths.
+# Label values are positional: metric.labels("poll").inc()
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        labels = format_labels(self.label_names, values)
+        return [f"{self.name}{labels} {format_value(child.value)}"]
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=STAGE_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, child.counts):
+            cumulative += count
+            labels = format_labels(self.label_names, values, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.label_names, values, [("le", "+Inf")])
+        lines.append(f"{self.name}_bucket{labels} {child.count}")
+        labels = format_labels(self.label_names, values)
+        lines.append(f"{self.name}_sum{labels} {format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+# Read at scrape time from a callback returning {label values: value}
+# (or a single number when there are no labels)
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, collect, labels=(), registry=None):
+        super().__init__(name, help, labels, registry)
+        self.collect = collect
+
+    def render(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in values.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "edgecaser_stage_seconds",
+    "Seconds spent in each stage of a run",
+    labels=("stage",),
+)
+RUNS = Counter("edgecaser_runs_total", "Runs by outcome", labels=("status",))
+FRAMES_CAPTURED = Counter(
+    "edgecaser_frames_captured_total",
+    "Frames received from the browser",
+    labels=("capture",),
+)
+FRAMES_DROPPED = Counter(
+    "edgecaser_frames_dropped_total",
+    "Captured frames dropped as identical to the previous one",
+)
+ROUTE_CALLBACKS = Counter(
+    "edgecaser_route_callbacks_total",
+    "Requests handled by Python route or Fetch callbacks",
+    labels=("handler",),
+)
+ENCODE_SECONDS = Histogram(
+    "edgecaser_encode_seconds",
+    "Seconds ffmpeg ran per video, by encoding profile",
+    labels=("profile",),
+)
+ENCODED_BYTES = Counter(
+    "edgecaser_encoded_bytes_total",
+    "Bytes of video written, by encoding profile",
+    labels=("profile",),
+)
+FFMPEG_FAILURES = Counter(
+    "edgecaser_ffmpeg_failures_total", "ffmpeg processes that did not write a video"
+)
+
+
+@contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+# Times the stages of one run: every stage is added to the run's own
+# breakdown (reported with its result) and to the STAGE_SECONDS histogram
+class StageTimer:
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+        STAGE_SECONDS.labels(name).observe(seconds)
+
+    def summary(self):
+        return {name: round(seconds, 3) for name, seconds in self.seconds.items()}
+
+
+# Serves the registry on http://host:port/metrics for processes without
+# the Quart app (workers)
+async def serve_metrics(port, host="0.0.0.0"):
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                status, body = "200 OK", REGISTRY.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Serving metrics on port {port}")
+    return server
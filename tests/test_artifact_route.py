@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import app, job_manager
+
+SESSION = "0f8e4c1a-5f43-4a52-9a36-3b3c1b9d2f10"
+
+
+@pytest.fixture
+def results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    session_dir = tmp_path / "static/results" / SESSION
+    session_dir.mkdir(parents=True)
+    for name in ("results_page.html", "done.mp4", "failed.mp4", "recording.har"):
+        (session_dir / name).write_bytes(b"x")
+    cache_dir = tmp_path / "static/results/cache"
+    cache_dir.mkdir()
+    (cache_dir / "index.json").write_text("{}")
+    yield
+    job_manager.jobs.pop(SESSION, None)
+
+
+def cache_control(path):
+    async def request():
+        response = await app.test_client().get(path)
+        return response.headers["Cache-Control"]
+
+    return asyncio.run(request())
+
+
+def add_job(finished):
+    job_manager.jobs[SESSION] = SimpleNamespace(
+        finished=finished, runs={"done": "done", "failed": "failed"}
+    )
+
+
+@pytest.mark.parametrize("name", ["results_page.html", "done.mp4"])
+def test_files_of_finished_runs_are_immutable(results, name):
+    add_job(finished=True)
+    assert "immutable" in cache_control(f"/static/results/{SESSION}/{name}")
+
+
+@pytest.mark.parametrize("name", ["failed.mp4", "recording.har"])
+def test_other_files_of_finished_jobs_are_revalidated(results, name):
+    add_job(finished=True)
+    assert "no-cache" in cache_control(f"/static/results/{SESSION}/{name}")
+
+
+def test_files_of_running_or_unknown_jobs_are_revalidated(results):
+    assert "no-cache" in cache_control(f"/static/results/{SESSION}/done.mp4")
+    add_job(finished=False)
+    assert "no-cache" in cache_control(f"/static/results/{SESSION}/done.mp4")
+
+
+def test_cache_index_is_revalidated(results):
+    assert "no-cache" in cache_control("/static/results/cache/index.json")
@@ -0,0 +1,108 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from quart import Quart, abort
+
+from artifacts import send_artifact, write_artifact
+
+SIZE = 1000
+
+
+@pytest.fixture
+def client(tmp_path):
+    (tmp_path / "video.mp4").write_bytes(bytes(range(250)) * 4)
+    write_artifact(tmp_path / "page.html", b"<html>" + b"x" * 500 + b"</html>")
+    app = Quart(__name__)
+
+    @app.route("/<name>")
+    async def artifact(name):
+        response = await send_artifact(Path(tmp_path / name), immutable=True)
+        if response is None:
+            abort(404)
+        return response
+
+    return app.test_client()
+
+
+def get(client, path, headers=None):
+    async def request():
+        response = await client.get(path, headers=headers or {})
+        return response, await response.get_data()
+
+    return asyncio.run(request())
+
+
+@pytest.mark.parametrize(
+    "header, begin, end",
+    [
+        ("bytes=0-0", 0, 1),
+        ("bytes=999-999", 999, 1000),
+        ("bytes=10-19", 10, 20),
+        ("bytes=990-", 990, 1000),
+        ("bytes=500-5000", 500, 1000),
+        ("bytes=-1", 999, 1000),
+        ("bytes=-10", 990, 1000),
+        ("bytes=-1000", 0, 1000),
+        ("bytes=-5000", 0, 1000),
+    ],
+)
+def test_single_range(client, header, begin, end):
+    response, data = get(client, "/video.mp4", {"Range": header})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes {begin}-{end - 1}/{SIZE}"
+    assert response.headers["Content-Length"] == str(end - begin)
+    assert data == (bytes(range(250)) * 4)[begin:end]
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1000-2000"])
+def test_range_out_of_bounds(client, header):
+    response, _ = get(client, "/video.mp4", {"Range": header})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{SIZE}"
+
+
+def test_multiple_ranges_send_whole_file(client):
+    response, data = get(client, "/video.mp4", {"Range": "bytes=0-9,20-29"})
+    assert response.status_code == 200
+    assert len(data) == SIZE
+
+
+def test_no_range(client):
+    response, data = get(client, "/video.mp4")
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert "immutable" in response.headers["Cache-Control"]
+    assert len(data) == SIZE
+
+
+def test_if_none_match(client):
+    response, _ = get(client, "/video.mp4")
+    etag = response.headers["ETag"]
+    response, data = get(client, "/video.mp4", {"If-None-Match": etag})
+    assert response.status_code == 304
+    assert data == b""
+
+
+def test_stale_if_range_sends_whole_file(client):
+    response, data = get(
+        client, "/video.mp4", {"Range": "bytes=0-9", "If-Range": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert len(data) == SIZE
+
+
+def test_precompressed(client):
+    response, data = get(client, "/page.html", {"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    plain, plain_data = get(client, "/page.html")
+    assert "Content-Encoding" not in plain.headers
+    assert len(plain_data) == 513
+    assert response.headers["ETag"] != plain.headers["ETag"]
+
+
+def test_missing(client):
+    response, _ = get(client, "/missing.mp4")
+    assert response.status_code == 404
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from app import TEST_OPTIONS, app, network_conditions
+
+
+def post(data):
+    async def request():
+        response = await app.test_client().post("/api/jobs", json=data)
+        return response.status_code, await response.get_json()
+
+    return asyncio.run(request())
+
+
+def test_matrix_larger_than_the_queue_is_rejected():
+    data = {
+        "url": "https://example.com",
+        "options": TEST_OPTIONS,
+        "network_profiles": ["none", *network_conditions],
+        "resolutions": ["1024x768", "1280x720", "1920x1080"],
+    }
+    status, body = post(data)
+    assert status == 400
+    assert "at most 50 runs" in body["error"]
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "javascript:alert(1)",
+        "file:///etc/passwd",
+        "http://",
+        "http://[::1",
+        "example.com",
+    ],
+)
+def test_only_http_urls_are_accepted(url):
+    status, body = post({"url": url, "options": ["disableCSS"]})
+    assert status == 400
+    assert body["error"] == "An http or https URL is required"
@@ -0,0 +1,514 @@
+import asyncio
+import time
+
+import config
+from frames import FrameBuffer, FrameDeduplicator
+from logger import logger
+from telemetry import ENCODE_SECONDS, ENCODED_BYTES, FFMPEG_FAILURES, FRAMES_DROPPED
+
+# ffmpeg decoder for each frame format piped on stdin
+INPUT_CODECS = {"png": "png", "jpeg": "mjpeg"}
+
+# Named output settings, picked per job (EDGECASER_ENCODING_PROFILE is the
+# default): the container's file extension, the widest output allowed
+# (None keeps the capture size) and the ffmpeg codec arguments
+ENCODING_PROFILES = {
+    "default": {
+        "extension": "mp4",
+        "max_width": None,
+        "codec": ["-c:v", "libx264", "-pix_fmt", "yuv420p"],
+    },
+    # Fastest encode and smallest file, for a quick look at many runs
+    "fast-preview": {
+        "extension": "mp4",
+        "max_width": 640,
+        "codec": [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-crf",
+            "30",
+            "-pix_fmt",
+            "yuv420p",
+        ],
+    },
+    # Slow but close to lossless at full size, for runs worth keeping
+    "archive": {
+        "extension": "mp4",
+        "max_width": None,
+        "codec": [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "slow",
+            "-crf",
+            "18",
+            "-pix_fmt",
+            "yuv420p",
+        ],
+    },
+    # Constant quality VP9 in WebM
+    "webm-vp9": {
+        "extension": "webm",
+        "max_width": None,
+        "codec": [
+            "-c:v",
+            "libvpx-vp9",
+            "-b:v",
+            "0",
+            "-crf",
+            "33",
+            "-deadline",
+            "good",
+            "-cpu-used",
+            "4",
+            "-row-mt",
+            "1",
+            "-pix_fmt",
+            "yuv420p",
+        ],
+    },
+}
+
+
+def video_filename(prefix, profile):
+    return f"{prefix}.{ENCODING_PROFILES[profile]['extension']}"
+
+
+# Even dimensions (yuv420p needs them), no wider than the profile allows
+def scale_filter(profile):
+    max_width = ENCODING_PROFILES[profile]["max_width"]
+    if max_width is None:
+        return "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+    return f"scale='min({max_width},trunc(iw/2)*2)':-2"
+
+
+# Pipes captured frames into a long-running ffmpeg process while the page
+# is still loading, so the video is finished moments after capture ends.
+# ffmpeg reads a constant frame clock; each frame is held on that clock
+# until the capture timestamp of the next one, which keeps playback in
+# line with wall-clock time no matter how irregularly frames arrive.
+# Identical frames are dropped before the pipe and the held repeats are
+# decimated again by ffmpeg, so the output is variable frame rate.
+# Every recorder in `recorders` also receives every distinct frame.
+class FrameStreamEncoder:
+    def __init__(
+        self,
+        output_path,
+        frame_format,
+        frame_rate=config.VIDEO_FRAME_RATE,
+        recorders=(),
+        profile=config.ENCODING_PROFILE,
+    ):
+        self.output_path = output_path
+        self.frame_format = frame_format
+        self.frame_rate = frame_rate
+        self.recorders = recorders
+        self.profile = profile
+        self.dedup = FrameDeduplicator()
+        self.frames_written = 0
+        self.process = None
+        self._stderr_task = None
+        self._last_frame = None
+        self._start_time = None
+        self._failed = False
+        # Seconds ffmpeg ran in total and after capture ended
+        self.encode_seconds = 0
+        self.finish_seconds = 0
+        # Size of the written video
+        self.output_bytes = 0
+        self.frame_bytes = 0
+        # Largest frame held for the pipe, the only frame kept in memory
+        self.held_bytes_max = 0
+        self._started_at = None
+
+    async def start(self):
+        self._started_at = time.monotonic()
+        self.process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "image2pipe",
+            "-framerate",
+            str(self.frame_rate),
+            "-c:v",
+            INPUT_CODECS[self.frame_format],
+            "-i",
+            "pipe:0",
+            # Drop exact repeats, keeping one every quarter second so the
+            # last frame still lasts until capture ended
+            "-vf",
+            f"mpdecimate=hi=0:lo=0:max={max(1, self.frame_rate // 4)},"
+            + scale_filter(self.profile),
+            "-vsync",
+            "vfr",
+            *ENCODING_PROFILES[self.profile]["codec"],
+            str(self.output_path),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self._stderr_task = asyncio.create_task(self.process.stderr.read())
+
+    async def write(self, data, timestamp):
+        # A duplicate just extends how long the held frame is shown
+        if self.dedup.is_duplicate(data):
+            FRAMES_DROPPED.inc()
+            return
+        for recorder in self.recorders:
+            recorder.add(data, timestamp)
+        if self._start_time is None:
+            self._start_time = timestamp
+        if self._last_frame is not None:
+            await self._write_held_frame(timestamp)
+        self._last_frame = data
+        self.frame_bytes += len(data)
+        self.held_bytes_max = max(self.held_bytes_max, len(data))
+
+    # Flush the last frame up to end_time and wait for ffmpeg to finish.
+    # Returns True when the video was written.
+    async def close(self, end_time):
+        closing_at = time.monotonic()
+        if self._last_frame is not None:
+            await self._write_held_frame(end_time, minimum=1)
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        returncode = await self.process.wait()
+        stderr = await self._stderr_task
+        self.encode_seconds = time.monotonic() - self._started_at
+        self.finish_seconds = time.monotonic() - closing_at
+        if self.frames_written == 0:
+            logger.info("No frames captured, video will not be created.")
+            return False
+        if returncode != 0 or self._failed:
+            FFMPEG_FAILURES.inc()
+            logger.info(
+                f"ffmpeg failed for {self.output_path}: {stderr.decode(errors='replace')}"
+            )
+            return False
+        self.output_bytes = (await asyncio.to_thread(self.output_path.stat)).st_size
+        logger.info(
+            f"Video created at: {self.output_path} from {self.dedup.frames} frames "
+            f"({self.dedup.duplicates} duplicates dropped)"
+        )
+        return True
+
+    # Frame memory of the run, reported with its result
+    def memory_stats(self):
+        return {
+            "frames": self.dedup.frames - self.dedup.duplicates,
+            "frame_bytes": self.frame_bytes,
+            "buffer_peak_bytes": self.held_bytes_max,
+            "spilled_bytes": 0,
+            "dropped_frames": 0,
+        }
+
+    async def abort(self):
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+
+    # Repeat the held frame until the output clock reaches `until`
+    async def _write_held_frame(self, until, minimum=0):
+        target = round((until - self._start_time) * self.frame_rate)
+        repeats = max(minimum, target - self.frames_written)
+        for _ in range(repeats):
+            if self._failed:
+                return
+            try:
+                self.process.stdin.write(self._last_frame)
+                await self.process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                self._failed = True
+                return
+            self.frames_written += 1
+
+
+# Buffers frames (see FrameBuffer) while capture runs and encodes them
+# later from the EncodeStage queue. Used when every encode slot is busy so
+# capture never waits on ffmpeg.
+class DeferredEncoder:
+    def __init__(
+        self,
+        stage,
+        output_path,
+        frame_format,
+        recorders=(),
+        profile=config.ENCODING_PROFILE,
+    ):
+        self.stage = stage
+        self.output_path = output_path
+        self.frame_format = frame_format
+        self.recorders = recorders
+        self.profile = profile
+        self.dedup = FrameDeduplicator()
+        self.buffer = FrameBuffer()
+        self.frame_bytes = 0
+
+    async def start(self):
+        pass
+
+    async def write(self, data, timestamp):
+        if self.dedup.is_duplicate(data):
+            FRAMES_DROPPED.inc()
+            return
+        for recorder in self.recorders:
+            recorder.add(data, timestamp)
+        self.frame_bytes += len(data)
+        await self.buffer.add(data, timestamp)
+
+    async def close(self, end_time):
+        try:
+            return await self.stage.submit(self, end_time)
+        finally:
+            # The frames are only needed until the video exists
+            await self._free()
+
+    async def abort(self):
+        await self._free()
+
+    # Frame memory of the run, reported with its result
+    def memory_stats(self):
+        return {
+            "frames": self.dedup.frames - self.dedup.duplicates,
+            "frame_bytes": self.frame_bytes,
+            **self.buffer.stats(),
+        }
+
+    async def _free(self):
+        self.stage.forget(self)
+        await self.buffer.clear()
+
+
+class LiveEncoder(FrameStreamEncoder):
+    def __init__(
+        self,
+        stage,
+        output_path,
+        frame_format,
+        recorders=(),
+        profile=config.ENCODING_PROFILE,
+    ):
+        super().__init__(
+            output_path, frame_format, recorders=recorders, profile=profile
+        )
+        self.stage = stage
+        self._released = False
+
+    async def close(self, end_time):
+        ok = False
+        try:
+            ok = await super().close(end_time)
+            return ok
+        finally:
+            self._release(ok)
+
+    async def abort(self):
+        await super().abort()
+        self._release(None)
+
+    def _release(self, ok):
+        if not self._released:
+            self._released = True
+            self.stage.release(self, ok)
+
+
+# Caps the number of ffmpeg processes running at once. A run gets a live
+# encoder while a slot is free; otherwise its frames are buffered and the
+# encode is queued. The queue is bounded, so when it is full finished
+# runs wait to submit (backpressure) instead of piling up more work.
+class EncodeStage:
+    def __init__(
+        self,
+        max_concurrent=config.MAX_CONCURRENT_ENCODES,
+        max_queued=config.MAX_QUEUED_ENCODES,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self._slots = None
+        self._queue = None
+        self._workers = []
+        self.active = 0
+        self.live_encodes = 0
+        self.deferred_encodes = 0
+        self.failed_encodes = 0
+        self.encode_seconds_total = 0
+        self.encode_seconds_max = 0
+        self.finish_seconds_total = 0
+        self.queue_wait_seconds_total = 0
+        # Encode time and output size per encoding profile
+        self.profiles = {}
+        # Deferred encoders still holding frames
+        self._deferred = set()
+
+    def start(self):
+        if self._workers:
+            return
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._queue = asyncio.Queue(self.max_queued)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    # Returns a started encoder exposing write(data, timestamp),
+    # close(end_time) and abort()
+    async def open(
+        self,
+        output_path,
+        frame_format,
+        recorders=(),
+        profile=config.ENCODING_PROFILE,
+    ):
+        self.start()
+        if not self._slots.locked():
+            await self._slots.acquire()
+            self.active += 1
+            encoder = LiveEncoder(self, output_path, frame_format, recorders, profile)
+        else:
+            logger.info(f"All encode slots busy, buffering frames for {output_path}")
+            encoder = DeferredEncoder(
+                self, output_path, frame_format, recorders, profile
+            )
+            self._deferred.add(encoder)
+        try:
+            await encoder.start()
+        except BaseException:
+            await encoder.abort()
+            raise
+        return encoder
+
+    # Called once by a LiveEncoder; ok is None when the run was aborted
+    def release(self, encoder, ok):
+        self.active -= 1
+        self._slots.release()
+        if ok is None:
+            self._record_abort(encoder)
+        else:
+            self.live_encodes += 1
+            self._record(encoder, ok)
+
+    # Called once a DeferredEncoder has freed its frames
+    def forget(self, deferred):
+        self._deferred.discard(deferred)
+
+    async def submit(self, deferred, end_time):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((deferred, end_time, future, time.monotonic()))
+        return await future
+
+    def stats(self):
+        completed = self.live_encodes + self.deferred_encodes
+        return {
+            "active": self.active,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "buffered_bytes": self.buffered_bytes(),
+            "live_encodes": self.live_encodes,
+            "deferred_encodes": self.deferred_encodes,
+            "failed_encodes": self.failed_encodes,
+            "encode_seconds_avg": self.encode_seconds_total / max(1, completed),
+            "encode_seconds_max": self.encode_seconds_max,
+            "finish_seconds_avg": self.finish_seconds_total / max(1, completed),
+            "queue_wait_seconds_avg": self.queue_wait_seconds_total
+            / max(1, self.deferred_encodes),
+            "profiles": {
+                name: {
+                    "encodes": profile["encodes"],
+                    "failed_encodes": profile["failed_encodes"],
+                    "encode_seconds_avg": profile["encode_seconds_total"]
+                    / max(1, profile["encodes"]),
+                    "output_bytes_avg": profile["output_bytes_total"]
+                    / max(1, profile["encodes"] - profile["failed_encodes"]),
+                }
+                for name, profile in self.profiles.items()
+            },
+        }
+
+    # Frame bytes held in memory by deferred encodes
+    def buffered_bytes(self):
+        return sum(deferred.buffer.memory_bytes for deferred in self._deferred)
+
+    def _profile(self, name):
+        return self.profiles.setdefault(
+            name,
+            {
+                "encodes": 0,
+                "failed_encodes": 0,
+                "encode_seconds_total": 0,
+                "output_bytes_total": 0,
+            },
+        )
+
+    # An aborted encode produced no video, so only the failure is counted
+    def _record_abort(self, encoder):
+        profile = self._profile(encoder.profile)
+        profile["encodes"] += 1
+        profile["failed_encodes"] += 1
+        self.failed_encodes += 1
+
+    def _record(self, encoder, ok):
+        profile = self._profile(encoder.profile)
+        profile["encodes"] += 1
+        if not ok:
+            self.failed_encodes += 1
+            profile["failed_encodes"] += 1
+        self.encode_seconds_total += encoder.encode_seconds
+        self.encode_seconds_max = max(self.encode_seconds_max, encoder.encode_seconds)
+        self.finish_seconds_total += encoder.finish_seconds
+        profile["encode_seconds_total"] += encoder.encode_seconds
+        profile["output_bytes_total"] += encoder.output_bytes
+        ENCODE_SECONDS.labels(encoder.profile).observe(encoder.encode_seconds)
+        ENCODED_BYTES.labels(encoder.profile).inc(encoder.output_bytes)
+        logger.info(
+            f"Encoded {encoder.output_path} with profile {encoder.profile} in "
+            f"{encoder.encode_seconds:.2f}s ({encoder.finish_seconds:.2f}s after "
+            f"capture), {encoder.output_bytes} bytes"
+        )
+
+    async def _worker(self):
+        while True:
+            deferred, end_time, future, queued_at = await self._queue.get()
+            ok = False
+            try:
+                async with self._slots:
+                    self.active += 1
+                    self.queue_wait_seconds_total += time.monotonic() - queued_at
+                    try:
+                        ok = await self._encode_buffered(deferred, end_time)
+                    finally:
+                        self.active -= 1
+            except Exception as e:
+                logger.info(f"Deferred encode failed for {deferred.output_path}: {e}")
+            finally:
+                self.deferred_encodes += 1
+                if not future.done():
+                    future.set_result(ok)
+                self._queue.task_done()
+
+    async def _encode_buffered(self, deferred, end_time):
+        encoder = FrameStreamEncoder(
+            deferred.output_path, deferred.frame_format, profile=deferred.profile
+        )
+        await encoder.start()
+        try:
+            async for data, timestamp in deferred.buffer.frames():
+                await encoder.write(data, timestamp)
+        except BaseException:
+            await encoder.abort()
+            raise
+        ok = await encoder.close(end_time)
+        self._record(encoder, ok)
+        return ok
+
+
+encode_stage = EncodeStage()
@@ -0,0 +1,89 @@
+import asyncio
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from logger import logger
+
+# Frames are compared at this size; colour histograms barely change with
+# the scale, and JPEG frames are decoded straight to it (DCT scaling)
+ANALYSIS_SIZE = (160, 120)
+# Offsets that give every colour channel its own 256 bins
+CHANNEL_OFFSETS = np.arange(3) * 256
+
+
+def decode_frame(data, size=ANALYSIS_SIZE):
+    image = Image.open(BytesIO(data))
+    image.draft("RGB", size)
+    return np.asarray(image.convert("RGB").resize(size))
+
+
+# One 256-bin histogram per colour channel, concatenated
+def frame_histogram(data):
+    pixels = decode_frame(data).reshape(-1, 3) + CHANNEL_OFFSETS
+    return np.bincount(pixels.ravel(), minlength=3 * 256)
+
+
+# Visual completeness of each frame: how far its histograms have moved from
+# the first frame towards the last one, between 0 and 1
+def completeness(histograms):
+    total = np.abs(histograms[-1] - histograms[0]).sum()
+    if total == 0:
+        return np.ones(len(histograms))
+    remaining = np.abs(histograms - histograms[-1]).sum(axis=1)
+    return np.clip(1 - remaining / total, 0, 1)
+
+
+# timestamps are the capture times of the frames, histograms their
+# (frames, 768) histograms and start_time is when navigation started.
+# Times are returned in ms.
+def analyze_histograms(timestamps, histograms, start_time):
+    timestamps = np.maximum((np.asarray(timestamps) - start_time) * 1000, 0)
+    progress = completeness(histograms)
+
+    changed = np.flatnonzero((histograms[1:] != histograms[:-1]).any(axis=1)) + 1
+    incomplete = np.flatnonzero(progress < 1)
+    complete_index = incomplete[-1] + 1 if len(incomplete) else 0
+    # Area above the completeness curve: the page counts as blank until the
+    # first frame, then each frame lasts until the next one
+    durations = np.diff(timestamps[: complete_index + 1])
+    speed_index = timestamps[0] + (durations * (1 - progress[:complete_index])).sum()
+
+    return {
+        "speedIndex": float(speed_index),
+        "firstVisualChange": float(timestamps[changed[0]]) if len(changed) else None,
+        "lastVisualChange": float(timestamps[changed[-1]]) if len(changed) else None,
+        "visuallyComplete": float(timestamps[complete_index]),
+        "frames": len(timestamps),
+        "progress": [
+            [round(float(time), 1), round(float(value) * 100, 1)]
+            for time, value in zip(timestamps, progress)
+        ],
+    }
+
+
+# Fed every distinct frame of a run by its encoder. Frames are decoded and
+# reduced to histograms in worker threads while capture is still running,
+# so only the histograms are kept and the analysis left once capture ends
+# is a few array operations.
+class VisualProgressRecorder:
+    def __init__(self):
+        self.timestamps = []
+        self._histograms = []
+
+    def add(self, data, timestamp):
+        self.timestamps.append(timestamp)
+        self._histograms.append(
+            asyncio.get_running_loop().run_in_executor(None, frame_histogram, data)
+        )
+
+    async def analyze(self, start_time):
+        if not self.timestamps:
+            return None
+        try:
+            histograms = np.stack(await asyncio.gather(*self._histograms))
+            return analyze_histograms(self.timestamps, histograms, start_time)
+        except Exception as e:
+            logger.info(f"Visual progress analysis failed: {e}")
+            return None
@@ -0,0 +1,137 @@
+import asyncio
+from collections import OrderedDict
+import os
+import socket
+import time
+import uuid
+
+from admission import admission, metrics_admission
+from browser_pool import browser_pool
+import config
+from job_store import open_job_store
+from jobs import Job
+from logger import logger, set_log_context
+from network_shaping import shaping_proxy
+from runs import run_option
+from telemetry import StageTimer, serve_metrics
+from video_encoder import encode_stage
+
+# Jobs kept around so later runs of a job share its HAR recording
+MAX_JOBS = 64
+
+
+# Leases runs from a JobStore and performs them with run_option. Each
+# worker process has its own browser pool, encoder and admission limits;
+# the results directory must be shared with the web process.
+class Worker:
+    def __init__(
+        self,
+        store,
+        run_option,
+        concurrency=config.WORKER_CONCURRENCY,
+        poll_interval=config.STORE_POLL_INTERVAL,
+    ):
+        self.store = store
+        self.run_option = run_option
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.jobs = OrderedDict()
+        self.completed = 0
+        self.failed = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def run(self):
+        logger.info(f"Worker {self.worker_id} waiting for runs")
+        try:
+            while True:
+                await self._slots.acquire()
+                try:
+                    lease = await self.store.lease(self.worker_id)
+                except Exception as e:
+                    logger.info(f"Could not lease a run: {e}")
+                    lease = None
+                if lease is None:
+                    self._slots.release()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                task = asyncio.create_task(self._process(lease))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _job(self, payload):
+        job = self.jobs.get(payload["job_id"])
+        if job is None:
+            job = self.jobs[payload["job_id"]] = Job.from_payload(payload)
+            if len(self.jobs) > MAX_JOBS:
+                self.jobs.popitem(last=False)
+        return job
+
+    async def _process(self, lease):
+        job = self._job(lease["job"])
+        spec = lease["spec"]
+        run_id = spec["run_id"]
+        set_log_context(job.job_id, run_id)
+        job.results.setdefault(run_id, {})
+        logger.info(f"Run {run_id} of job {job.job_id}, attempt {lease['attempt']}")
+        heartbeat = asyncio.create_task(self._heartbeat(job.job_id, run_id))
+        try:
+            controller = metrics_admission if job.metrics_only else admission
+            controller.reserve(1)
+            timer = StageTimer()
+            queued_at = time.perf_counter()
+            async with controller.slot(job.host):
+                timer.record("queue_wait", time.perf_counter() - queued_at)
+                await self.run_option(job, spec, timer)
+            await self.store.complete(
+                job.job_id, run_id, self.worker_id, job.run_result(run_id)
+            )
+            self.completed += 1
+        except Exception as e:
+            logger.info(f"Run {run_id} of job {job.job_id} failed: {e}")
+            self.failed += 1
+            try:
+                await self.store.fail(job.job_id, run_id, self.worker_id, str(e))
+            except Exception as e:
+                logger.info(f"Could not report failed run {run_id}: {e}")
+        finally:
+            heartbeat.cancel()
+            self._slots.release()
+
+    # Renews the lease well before it runs out
+    async def _heartbeat(self, job_id, run_id):
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            try:
+                if not await self.store.heartbeat(job_id, run_id, self.worker_id):
+                    logger.info(f"Lost the lease on run {run_id} of job {job_id}")
+                    return
+            except Exception as e:
+                logger.info(f"Heartbeat for run {run_id} failed: {e}")
+
+
+async def main():
+    if not config.JOB_STORE:
+        raise SystemExit("Set EDGECASER_JOB_STORE to run a worker")
+    store = open_job_store()
+    # Each worker exposes its own counters and stage histograms
+    if config.WORKER_METRICS_PORT:
+        await serve_metrics(config.WORKER_METRICS_PORT)
+    await browser_pool.start()
+    encode_stage.start()
+    try:
+        await Worker(store, run_option).run()
+    finally:
+        await encode_stage.stop()
+        await browser_pool.stop()
+        await shaping_proxy.stop()
+        await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())